@@ -16,5 +16,6 @@
 
 from . import utils
 from . import model
+from . import cache
 
-__all__ = ['utils', 'model']
+__all__ = ['utils', 'model', 'cache']
@@ -0,0 +1,175 @@
+# Backward compatibility with Python 2.
+from __future__ import print_function, absolute_import, division
+
+# Suppress all warnings.
+import warnings
+
+warnings.filterwarnings('ignore')
+
+import sys
+import json
+import time
+import argparse
+import resource
+import itertools
+import multiprocessing
+
+# Metrics compared against the baseline, & whether higher is better.
+METRICS = {'build_time': False, 'train_chars_per_sec': True, 'sample_chars_per_sec': True, 'peak_rss_mb': False}
+
+# Configuration identifying a benchmark point.
+CONFIG = ('model', 'backend', 'vocab_size', 'rnn_size', 'num_layers', 'batch_size', 'seq_length')
+
+
+def main():
+    # Argument parser.
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    # Command line arguments.
+    parser.add_argument('--models', type=str, nargs='+', default=['rnn', 'lstm', 'gru', 'nas'],
+                        help='Recurrent architectures to benchmark.')
+    parser.add_argument('--rnn_sizes', type=int, nargs='+', default=[128, 256],
+                        help='Sizes of RNN hidden cell state.')
+    parser.add_argument('--num_layers', type=int, nargs='+', default=[2],
+                        help='Numbers of hidden layers.')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[50],
+                        help='Mini batch sizes.')
+    parser.add_argument('--seq_lengths', type=int, nargs='+', default=[50],
+                        help='Recurrent sequence lengths.')
+    parser.add_argument('--backend', type=str, default='static', choices=['static', 'dynamic', 'fused'],
+                        help='Recurrence backend of every point.')
+    parser.add_argument('--vocab_size', type=int, default=96,
+                        help='Size of the synthetic vocabulary.')
+    parser.add_argument('--steps', type=int, default=20,
+                        help='Number of timed training steps, after one warm-up step.')
+    parser.add_argument('--sample_batch', type=int, default=8,
+                        help='Number of sequences sampled together.')
+    parser.add_argument('--sample_length', type=int, default=500,
+                        help='Number of characters sampled per sequence.')
+    parser.add_argument('--output', type=str, default='benchmark.json',
+                        help='JSON file the results are written to.')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='JSON results of a previous run to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative change of a metric past which it is flagged as a regression.')
+
+    # Parse the arguments.
+    args = parser.parse_args()
+
+    # Every point runs in a fresh process, for its own graph & peak memory.
+    points = [dict(zip(CONFIG, values)) for values in itertools.product(args.models, [args.backend],
+                                                                         [args.vocab_size], args.rnn_sizes,
+                                                                         args.num_layers, args.batch_sizes,
+                                                                         args.seq_lengths)]
+    context = multiprocessing.get_context('spawn')
+
+    print('{:>5} {:>8} {:>6} {:>6} {:>7} {:>10} {:>14} {:>14} {:>10}'
+          .format('model', 'rnn_size', 'layers', 'batch', 'seq_len', 'build (s)', 'train char/s',
+                  'sample char/s', 'RSS (MiB)'))
+    results = []
+    for point in points:
+        with context.Pool(processes=1) as pool:
+            result = pool.apply(benchmark, (args, point))
+        results.append(result)
+        print('{model:>5} {rnn_size:>8} {num_layers:>6} {batch_size:>6} {seq_length:>7} {build_time:>10.2f} '
+              '{train_chars_per_sec:>14,.0f} {sample_chars_per_sec:>14,.0f} {peak_rss_mb:>10.1f}'.format(**result))
+
+    with open(args.output, mode='w') as f:
+        json.dump(results, f, indent=2)
+    print('\nResults written to {}'.format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline, mode='r') as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+        for point, metric, old, new in regressions:
+            print('REGRESSION {}: {} {:.4g} -> {:.4g} ({:+.1%})'
+                  .format(' '.join('{}={}'.format(key, point[key]) for key in CONFIG), metric, old, new,
+                          (new - old) / old))
+        print('{} regression(s) against {}'.format(len(regressions), args.baseline))
+
+        # Non-zero exit status, e.g. to fail a CI job.
+        if regressions:
+            sys.exit(1)
+
+
+def benchmark(args, point: dict):
+    """Train & sample a model of one configuration on a synthetic corpus.
+
+    Arguments:
+        args {argparse.Namespace} -- Command line arguments, see `main`.
+        point {dict} -- Configuration: model, backend, vocab_size, rnn_size, num_layers, batch_size
+            & seq_length.
+
+    Returns:
+        {dict} -- The configuration, graph build time (s), training & sampling throughput (chars/s)
+            and peak resident memory of the process (MiB).
+    """
+    import tensorflow as tf
+    from model import Model
+    from compare_backends import make_model_args, time_training
+
+    result = dict(point)
+
+    # Training: graph build time & throughput on random ids.
+    result['build_time'], _, step = time_training(make_model_args(**point), steps=args.steps)
+    result['train_chars_per_sec'] = point['batch_size'] * point['seq_length'] / step
+
+    # Sampling: throughput of a batch of sequences, over a synthetic vocab.
+    with tf.Graph().as_default():
+        model = Model(make_model_args(**point), training=False)
+        model.build_sampler()
+
+        chars = tuple(chr(ord('!') + i) for i in range(args.vocab_size))
+        vocab = {char: i for i, char in enumerate(chars)}
+        primes = [chars[i % args.vocab_size] for i in range(args.sample_batch)]
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            model.sample_batch(sess, chars, vocab, primes, num=1)
+
+            start = time.time()
+            model.sample_batch(sess, chars, vocab, primes, num=args.sample_length)
+            result['sample_chars_per_sec'] = args.sample_batch * args.sample_length / (time.time() - start)
+
+    # Kilobytes on Linux.
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    return result
+
+
+def compare(results: list, baseline: list, tolerance: float = 0.1):
+    """Metrics worse than their baseline by more than `tolerance`.
+
+    Arguments:
+        results {list} -- Benchmark results, see `benchmark`.
+        baseline {list} -- Results of a previous run. Points missing from it (e.g. of another backend
+            or vocab size) aren't compared.
+
+    Keyword Arguments:
+        tolerance {float} -- Relative change of a metric flagged as a regression. (default: {0.1})
+
+    Returns:
+        {list} -- (point, metric, baseline value, new value) of every regression.
+    """
+    previous = {tuple(result.get(key) for key in CONFIG): result for result in baseline}
+
+    regressions = []
+    for result in results:
+        old = previous.get(tuple(result[key] for key in CONFIG))
+        if old is None:
+            continue
+
+        for metric, higher_is_better in METRICS.items():
+            if not old.get(metric):
+                continue
+            change = (result[metric] - old[metric]) / old[metric]
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append((result, metric, old[metric], result[metric]))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    main()
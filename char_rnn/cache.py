@@ -0,0 +1,146 @@
+"""Cache of recurrent states reached after reading a prime."""
+
+import collections
+import threading
+
+
+def state_nbytes(state):
+    """Number of bytes held by a (nested) recurrent state of NumPy arrays.
+
+    Arguments:
+        state {tuple} -- Recurrent state, e.g. a tuple of `LSTMStateTuple`s.
+
+    Returns:
+        {int} -- Total size of the arrays in bytes.
+    """
+    if isinstance(state, (tuple, list)):
+        return sum(state_nbytes(s) for s in state)
+    return state.nbytes
+
+
+class _Node:
+    """Node of the prefix trie: children by character & whether a state is cached here."""
+    __slots__ = ('children', 'cached')
+
+    def __init__(self):
+        self.children = {}
+        self.cached = False
+
+
+class PrefixStateCache:
+    """LRU cache mapping prime prefixes to the recurrent state reached after reading them.
+
+    Primes are sequences of ids (characters or tokens) or plain strings. Cached prefixes
+    are also stored in a trie, so the longest cached prefix of a new prime is found in
+    a single walk down the trie. Only the remaining suffix then has to be fed through
+    the network. The least recently used states are evicted
+    once either bound is exceeded.
+
+    Keyword Arguments:
+        max_entries {int} -- Maximum number of cached states. (default: {128})
+        max_bytes {int} -- Maximum total size of the cached states, in bytes. (default: {64 MiB})
+    """
+
+    def __init__(self, max_entries: int = 128, max_bytes: int = 64 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # Prefix -> (state, size in bytes), least recently used first.
+        self._entries = collections.OrderedDict()
+        self._root = _Node()
+        self._lock = threading.Lock()
+
+        # Counters.
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_chars = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, text: str):
+        """Find the longest cached prefix of `text`.
+
+        Arguments:
+            text {tuple} -- Ids (or text) about to be fed through the network.
+
+        Returns:
+            {tuple} -- Length of the longest cached prefix & its state, (0, None) on a miss.
+        """
+        with self._lock:
+            node, length = self._root, 0
+            for i, char in enumerate(text):
+                node = node.children.get(char)
+                if node is None:
+                    break
+                if node.cached:
+                    length = i + 1
+
+            if length == 0:
+                self.misses += 1
+                return 0, None
+
+            prefix = text[:length]
+            self._entries.move_to_end(prefix)
+            self.hits += 1
+            self.hit_chars += length
+            return length, self._entries[prefix][0]
+
+    def insert(self, text: str, state):
+        """Cache the state reached after reading `text`.
+
+        Arguments:
+            text {tuple} -- Prefix ids (or text) fed through the network.
+            state {tuple} -- Recurrent state of NumPy arrays (batch size 1) after reading `text`.
+        """
+        if not text:
+            return
+
+        nbytes = state_nbytes(state)
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if text in self._entries:
+                self.nbytes -= self._entries[text][1]
+
+            self._entries[text] = (state, nbytes)
+            self._entries.move_to_end(text)
+            self.nbytes += nbytes
+
+            node = self._root
+            for char in text:
+                node = node.children.setdefault(char, _Node())
+            node.cached = True
+
+            # Evict least recently used states.
+            while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+                prefix, (_, size) = self._entries.popitem(last=False)
+                self.nbytes -= size
+                self.evictions += 1
+                self._remove(prefix)
+
+    def _remove(self, text: str):
+        """Unmark `text` in the trie & prune the nodes no longer leading to a cached state."""
+        path = [self._root]
+        for char in text:
+            path.append(path[-1].children[char])
+        path[-1].cached = False
+
+        for i in range(len(text), 0, -1):
+            node = path[i]
+            if node.cached or node.children:
+                break
+            del path[i - 1].children[text[i - 1]]
+
+    def stats(self):
+        """Hit/miss counters & current size of the cache.
+
+        Returns:
+            {dict} -- entries, nbytes, hits, misses, hit_chars & evictions.
+        """
+        with self._lock:
+            return {'entries': len(self._entries), 'nbytes': self.nbytes, 'hits': self.hits,
+                    'misses': self.misses, 'hit_chars': self.hit_chars, 'evictions': self.evictions}
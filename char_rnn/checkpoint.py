@@ -0,0 +1,135 @@
+"""Checkpoints written on a background thread, from a snapshot of the variables."""
+
+import time
+import threading
+
+import tensorflow as tf
+
+
+class AsyncCheckpointer:
+    """Save checkpoints without stalling training for the serialization.
+
+    Every variable has a non-trainable shadow copy. Saving only assigns the variables
+    to their shadows, an on-device copy, and hands the write over to a background
+    thread. The shadows are saved under the names of the original variables, so the
+    checkpoints restore with a plain `tf.train.Saver` (or `tf.train.latest_checkpoint`).
+
+    At most one write is in flight: saving again first waits for the previous write,
+    whose shadows mustn't change until it's done. Call `flush` (or `close`) before
+    exiting for a final blocking write. Works both in graph & eager mode.
+
+    Keyword Arguments:
+        var_list {list} -- Variables to be saved. (default: {None} -- all global variables)
+        max_to_keep {int} -- Number of most recent checkpoints kept, older ones are deleted.
+            (default: {5})
+        keep_checkpoint_every_n_hours {float} -- Also keep one checkpoint every n hours.
+            (default: {10000.})
+    """
+
+    def __init__(self, var_list: list = None, max_to_keep: int = 5, keep_checkpoint_every_n_hours: float = 10000.):
+        if var_list is None:
+            var_list = tf.global_variables()
+
+        # Shadow copy of every variable, outside of any collection.
+        with tf.name_scope('checkpoint'):
+            self.shadows = {}
+            for var in var_list:
+                name = var.name.split(':')[0]
+                self.shadows[name] = tf.Variable(tf.zeros(var.shape, dtype=var.dtype.base_dtype),
+                                                 trainable=False, collections=[],
+                                                 name='shadow/{}'.format(name))
+            self.var_list = list(var_list)
+
+            if not tf.executing_eagerly():
+                self._snapshot = tf.group(*[shadow.assign(var) for shadow, var in
+                                            zip(self.shadows.values(), self.var_list)], name='snapshot')
+                self._initializer = tf.variables_initializer(list(self.shadows.values()))
+        self._initialized = False
+
+        # Shadows are saved under the names of the original variables.
+        self.saver = tf.train.Saver(var_list=self.shadows, max_to_keep=max_to_keep,
+                                    keep_checkpoint_every_n_hours=keep_checkpoint_every_n_hours)
+
+        self._thread = None
+        self._error = None
+        self.last_checkpoint = None
+
+        # Time spent by the caller (waiting & snapshotting) vs. the background writes.
+        self.stall_time = 0.
+        self.write_time = 0.
+
+    def save(self, save_path: str, global_step=None, sess: tf.Session = None):
+        """Snapshot the variables & write them on a background thread.
+
+        Arguments:
+            save_path {str} -- Prefix of the checkpoint files.
+
+        Keyword Arguments:
+            global_step {tf.Variable} -- Step number appended to `save_path`. (default: {None})
+            sess {tf.Session} -- Session holding the variables, in graph mode. (default: {None})
+
+        Raises:
+            Exception -- Previous write failed.
+        """
+        start = time.time()
+        self.flush()
+
+        if tf.executing_eagerly():
+            for shadow, var in zip(self.shadows.values(), self.var_list):
+                shadow.assign(var)
+            step = None if global_step is None else int(global_step.numpy())
+        else:
+            if not self._initialized:
+                sess.run(self._initializer)
+                self._initialized = True
+            if global_step is None:
+                step = None
+                sess.run(self._snapshot)
+            else:
+                _, step = sess.run([self._snapshot, global_step])
+
+        self._thread = threading.Thread(target=self._write, args=(sess, save_path, step), name='Checkpointer')
+        self._thread.start()
+        self.stall_time += time.time() - start
+
+    def _write(self, sess: tf.Session, save_path: str, step: int):
+        """Write the shadows, recording any error for the caller."""
+        start = time.time()
+        try:
+            self.last_checkpoint = self.saver.save(sess=sess, save_path=save_path, global_step=step)
+        except Exception as e:
+            self._error = e
+        self.write_time += time.time() - start
+
+    def flush(self):
+        """Block until the write in flight, if any, is done.
+
+        Raises:
+            Exception -- Write failed.
+
+        Returns:
+            {str} -- Path of the last checkpoint written, or None.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+        return self.last_checkpoint
+
+    def close(self):
+        """Final blocking flush.
+
+        Returns:
+            {str} -- Path of the last checkpoint written, or None.
+        """
+        return self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,99 @@
+# Backward compatibility with Python 2.
+from __future__ import print_function, absolute_import, division
+
+# Suppress all warnings.
+import warnings
+
+warnings.filterwarnings('ignore')
+
+import time
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+from model import Model
+
+
+def main():
+    # Argument parser.
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    # Command line arguments.
+    parser.add_argument('--backends', type=str, nargs='+', default=['static', 'dynamic', 'fused'],
+                        help='Backends to compare.')
+    parser.add_argument('--seq_lengths', type=int, nargs='+', default=[25, 50, 100, 200],
+                        help='Sequence lengths to compare the backends on.')
+    parser.add_argument('--model', type=str, default='lstm',
+                        help='Recurrent architecture: RNN, LSTM, GRU or NAS')
+    parser.add_argument('--rnn_size', type=int, default=128,
+                        help='Size of RNN hidden cell state.')
+    parser.add_argument('--num_layers', type=int, default=2,
+                        help='Number of hidden layers in the network.')
+    parser.add_argument('--batch_size', type=int, default=50,
+                        help='Mini batch size.')
+    parser.add_argument('--vocab_size', type=int, default=96,
+                        help='Size of the (synthetic) vocabulary.')
+    parser.add_argument('--steps', type=int, default=20,
+                        help='Number of timed training steps, after one warm-up step.')
+
+    # Parse the arguments.
+    args = parser.parse_args()
+
+    print('{:>8} {:>10} {:>10} {:>10} {:>12}'.format('backend', 'seq_length', 'build (s)', 'graph ops', 'step (ms)'))
+    for seq_length in args.seq_lengths:
+        for backend in args.backends:
+            model_args = make_model_args(model=args.model, backend=backend, rnn_size=args.rnn_size,
+                                         num_layers=args.num_layers, batch_size=args.batch_size,
+                                         seq_length=seq_length, vocab_size=args.vocab_size)
+            build, ops, step = time_training(model_args, steps=args.steps)
+            print('{:>8} {:>10} {:>10.2f} {:>10} {:>12.2f}'.format(backend, seq_length, build, ops, step * 1000.))
+
+
+def make_model_args(**config):
+    """Model arguments of a configuration, without dropout & with the training defaults.
+
+    Keyword Arguments:
+        **config -- model, backend, rnn_size, num_layers, batch_size, seq_length & vocab_size.
+
+    Returns:
+        {argparse.Namespace} -- Arguments of `Model`.
+    """
+    return argparse.Namespace(input_keep_prob=1.0, output_keep_prob=1.0, grad_clip=5., learning_rate=1e-2,
+                              **config)
+
+
+def time_training(model_args: argparse.Namespace, steps: int):
+    """Build a training model in a fresh graph & time its training steps on random ids.
+
+    Arguments:
+        model_args {argparse.Namespace} -- Model arguments, see `make_model_args`.
+        steps {int} -- Number of timed training steps, after one warm-up step.
+
+    Returns:
+        {tuple} -- Graph build time (s), number of ops in the graph & mean step time (s).
+    """
+    with tf.Graph().as_default() as graph:
+        start = time.time()
+        model = Model(model_args, training=True)
+        build = time.time() - start
+        ops = len(graph.get_operations())
+
+        x = np.random.randint(model_args.vocab_size, size=(model_args.batch_size, model_args.seq_length),
+                              dtype=np.int32)
+        feed = {model.input_data: x, model.targets: np.roll(x, -1, axis=1)}
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run([model.loss, model.train_op], feed_dict=feed)
+
+            start = time.time()
+            for _ in range(steps):
+                sess.run([model.loss, model.train_op], feed_dict=feed)
+            step = (time.time() - start) / max(steps, 1)
+
+    return build, ops, step
+
+
+if __name__ == '__main__':
+    main()
@@ -6,13 +6,47 @@ import warnings
 
 warnings.filterwarnings('ignore')
 
+import functools
+
 import tensorflow as tf
 from tensorflow.contrib import rnn
 from tensorflow.contrib import legacy_seq2seq
+from tensorflow.contrib.framework import nest
 
 import numpy as np
 
 
+def make_iterator(data_loader, prefetch: int = 2):
+    """Input pipeline over the batches of a `TextLoader`.
+
+    Batches are pulled from the loader by the tf.data runtime and prefetched, so the
+    training loop doesn't feed them through `feed_dict`. The iterator yields whatever
+    is left of the loader's current epoch & must be re-initialized after every
+    `data_loader.reset_batch_pointer()`.
+
+    Arguments:
+        data_loader {TextLoader} -- Data loader (or `BatchPrefetcher`) providing the batches.
+
+    Keyword Arguments:
+        prefetch {int} -- Number of batches prefetched by the pipeline. (default: {2})
+
+    Returns:
+        {tf.data.Iterator} -- Initializable iterator of (input_data, targets) batches.
+    """
+
+    def generator():
+        while data_loader.pointer < data_loader.num_batches:
+            x, y = data_loader.next_batch()
+            yield x.astype(np.int32), y.astype(np.int32)
+
+    shape = tf.TensorShape([data_loader.batch_size, data_loader.seq_length])
+    dataset = tf.data.Dataset.from_generator(generator, output_types=(tf.int32, tf.int32),
+                                             output_shapes=(shape, shape))
+    dataset = dataset.prefetch(buffer_size=prefetch)
+
+    return dataset.make_initializable_iterator()
+
+
 class Model:
     """Multi-layer Recurrent Neural Networks (LSTM, RNN) for character-level language models.
 
@@ -24,13 +58,22 @@ class Model:
 
     Keyword Arguments:
         training {bool} -- Training mode. (default: {True})
+        inputs {tuple} -- (input_data, targets) tensors, e.g. from `make_iterator(...).get_next()`.
+            (default: {None} -- placeholders fed at every step)
+        stateful {bool} -- Carry the recurrent state from one step to the next in non-trainable
+            variables, updated by `train_op` & zeroed by `reset_state`, instead of fetching and
+            feeding it at every step. (default: {False})
 
     Raises:
         ValueError -- Model type not supported. Supported types include:
                             RNN, LSTM, GRU and NAS.
+        ValueError -- Backend not supported, see `args.backend`: static (default), dynamic or
+                            fused (LSTM & GRU only).
+        ValueError -- Softmax not supported, see `args.softmax`: full (default) or sampled,
+                            with `args.num_sampled` negative classes per position.
     """
 
-    def __init__(self, args, training=True):
+    def __init__(self, args, training=True, inputs=None, stateful=False):
         self.args = args
 
         # Set batch size & sequence length to 1 if not in training mode.
@@ -38,6 +81,21 @@ class Model:
             args.batch_size = 1
             args.seq_length = 1
 
+        # Backend running the recurrence over the whole sequence (older configs: static).
+        self.backend = getattr(args, 'backend', 'static').lower()
+        if self.backend not in ('static', 'dynamic', 'fused'):
+            raise ValueError("Backend not supported.")
+
+        # Optimizer steps per `sess.run` of the training loop (older configs: 1). Steps inside a
+        # `tf.while_loop` read every variable afresh only if it's a resource variable.
+        self.steps_per_run = getattr(args, 'steps_per_run', 1)
+        use_resource = True if training and self.steps_per_run > 1 else None
+
+        # Training loss over the full vocab or a sample of it (older configs: full).
+        self.softmax = getattr(args, 'softmax', 'full').lower()
+        if self.softmax not in ('full', 'sampled'):
+            raise ValueError("Softmax not supported.")
+
         # Recurrent Architecture.
         if args.model.lower() == 'rnn':
             cell_fn = rnn.BasicRNNCell
@@ -50,6 +108,15 @@ class Model:
         else:
             raise ValueError("Model type not supported.")
 
+        # Block kernels, named like the cells above so checkpoints are interchangeable.
+        if self.backend == 'fused':
+            if args.model.lower() == 'lstm':
+                cell_fn = functools.partial(rnn.LSTMBlockCell, name='basic_lstm_cell')
+            elif args.model.lower() == 'gru':
+                cell_fn = functools.partial(rnn.GRUBlockCellV2, name='gru_cell')
+            else:
+                raise ValueError("Fused backend only supports LSTM & GRU.")
+
         # Construct the hidden layers' cell.
         cell = None
         cells = []
@@ -69,26 +136,154 @@ class Model:
         # Recurrent Cell.
         self.cell = rnn.MultiRNNCell(cells=cells, state_is_tuple=True)
 
-        # Model placeholders.
-        self.input_data = tf.placeholder(dtype=tf.int32, shape=[args.batch_size, args.seq_length], name="input_data")
-        self.targets = tf.placeholder(dtype=tf.int32, shape=[args.batch_size, args.seq_length], name="targets")
-        self.initial_state = cell.zero_state(batch_size=args.batch_size, dtype=tf.float32)
+        # Model inputs: placeholders, unless given by an input pipeline.
+        if inputs is None:
+            self.input_data = tf.placeholder(dtype=tf.int32, shape=[args.batch_size, args.seq_length],
+                                             name="input_data")
+            self.targets = tf.placeholder(dtype=tf.int32, shape=[args.batch_size, args.seq_length], name="targets")
+        else:
+            self.input_data, self.targets = inputs
+            self.input_data.set_shape([args.batch_size, args.seq_length])
+            self.targets.set_shape([args.batch_size, args.seq_length])
+        self.initial_state = self.cell.zero_state(batch_size=args.batch_size, dtype=tf.float32)
+
+        # Model's variables, as resource variables if needed, under their usual names.
+        with tf.variable_scope(tf.get_variable_scope(), use_resource=use_resource):
+            # Recurrent state kept in (local) variables between steps.
+            self.state_variables = []
+            if stateful:
+                with tf.variable_scope('state'):
+                    self.state_variables = [tf.Variable(state, trainable=False, name='state_{}'.format(i),
+                                                        collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                                            for i, state in enumerate(nest.flatten(self.initial_state))]
+                self.initial_state = nest.pack_sequence_as(self.initial_state,
+                                                           [var.read_value() for var in self.state_variables])
+
+            # Recurrent Neural Net Language Modelling.
+            with tf.variable_scope('rnnlm'):
+                softmax_W = tf.get_variable(name='softmax_W', shape=[args.rnn_size, args.vocab_size])
+                softmax_b = tf.get_variable(name='softmax_b', shape=[args.vocab_size])
+
+            # Embeddings.
+            embedding = tf.get_variable('embedding', shape=[args.vocab_size, args.rnn_size])
+
+            # Kept around to run the network one step at a time while sampling.
+            self.softmax_W, self.softmax_b, self.embedding = softmax_W, softmax_b, embedding
+            self._zero_state = self.cell.zero_state(batch_size=1, dtype=tf.float32)
+            self._sampler = None
+            self._beam_search = None
+            self._train_loop = None
+            self.training = training
+
+            # Network & loss.
+            self.logits, seq_loss, self.loss, self.eval_loss, self.final_state = self._forward(
+                self.input_data, self.targets, self.initial_state)
+            self.probs = tf.nn.softmax(self.logits, name="probs")
+
+            self.lr = tf.Variable(0.0, trainable=False, name="learning_rate")
+
+            # Trainable variables & gradient clipping.
+            tvars = tf.trainable_variables()
+            grads, _ = tf.clip_by_global_norm(t_list=tf.gradients(self.loss, tvars),
+                                              clip_norm=args.grad_clip)
+
+            # Optimizer.
+            with tf.variable_scope("optimizer"):
+                self.global_step = tf.Variable(0, trainable=False, name="global_step")
+                optimizer = tf.train.AdamOptimizer(learning_rate=args.learning_rate)
+
+            # Train ops.
+            self.train_op = optimizer.apply_gradients(grads_and_vars=zip(grads, tvars),
+                                                      global_step=self.global_step,
+                                                      name="train_op")
+            self._optimizer, self._tvars = optimizer, tvars
+
+            # Carry the final state over to the next step, once the update has been applied.
+            self.reset_state = tf.no_op(name="reset_state")
+            if stateful:
+                with tf.control_dependencies([self.train_op]):
+                    self.train_op = tf.group(*[tf.assign(var, state) for var, state in
+                                               zip(self.state_variables, nest.flatten(self.final_state))],
+                                             name="update_state")
+                self.reset_state = tf.variables_initializer(self.state_variables, name="reset_state")
+
+        # Tensorboard: cheap scalars & costly histograms (over the whole batch), to be
+        # fetched at separate cadences.
+        histograms = [tf.summary.histogram('seq_loss', seq_loss)]
+        if self.softmax == 'full':
+            histograms.append(tf.summary.histogram('logits', self.logits))
+        self.histogram_summaries = tf.summary.merge(histograms, name='histogram_summaries')
+        self.scalar_summaries = tf.summary.merge([tf.summary.scalar('loss', self.loss)], name='scalar_summaries')
+
+    def _forward(self, input_data: tf.Tensor, targets: tf.Tensor, initial_state):
+        """Build the network & its loss over a batch, creating (or reusing) the cells' variables.
 
-        # Recurrent Neural Net Language Modelling.
-        with tf.variable_scope('rnnlm'):
-            softmax_W = tf.get_variable(name='softmax_W', shape=[args.rnn_size, args.vocab_size])
-            softmax_b = tf.get_variable(name='softmax_b', shape=[args.vocab_size])
+        Arguments:
+            input_data {tf.Tensor} -- Input ids, shape [batch_size, seq_length].
+            targets {tf.Tensor} -- Target ids, shape [batch_size, seq_length].
+            initial_state {tuple} -- Recurrent state at the start of the batch.
 
-        # Embeddings.
-        embedding = tf.get_variable('embedding', shape=[args.vocab_size, args.rnn_size])
-        inputs = tf.nn.embedding_lookup(embedding, self.input_data)
+        Returns:
+            {tuple} -- Full logits, training loss of every position, mean training loss,
+                mean full softmax loss & final state.
+        """
+        args, training = self.args, self.training
+        inputs = tf.nn.embedding_lookup(self.embedding, input_data)
 
         # Dropout input embeddings.
         if training:
             inputs = tf.nn.dropout(inputs, keep_prob=args.input_keep_prob)
 
+        # Recurrence.
+        if self.backend == 'static':
+            outputs, final_state = self._static_rnn(inputs, initial_state)
+        elif self.backend == 'fused' and args.model.lower() == 'lstm':
+            outputs, final_state = self._fused_lstm(inputs, initial_state)
+        else:
+            # Block GRU cells (fused backend) are also stepped by `dynamic_rnn`.
+            outputs, final_state = tf.nn.dynamic_rnn(self.cell, inputs, initial_state=initial_state,
+                                                     scope='rnnlm')
+
+        outputs = tf.reshape(outputs, shape=[-1, args.rnn_size])
+
+        # Fully connected & softmax layer, over the full vocab for evaluation & sampling.
+        logits = tf.matmul(outputs, self.softmax_W) + self.softmax_b
+
+        # Loss function.
+        with tf.variable_scope('loss'):
+            targets = tf.reshape(targets, shape=[-1])
+
+            full_loss = legacy_seq2seq.sequence_loss_by_example(
+                logits=[logits],
+                targets=[targets],
+                weights=[tf.ones(shape=[args.batch_size * args.seq_length])])
+            eval_loss = tf.reduce_sum(full_loss) / args.batch_size / args.seq_length
+
+            # Only a few negative classes per position, drawn from a log-uniform (Zipfian)
+            # distribution, which fits TextLoader's character (or token) ids sorted by decreasing frequency.
+            if training and self.softmax == 'sampled':
+                seq_loss = tf.nn.sampled_softmax_loss(weights=tf.transpose(self.softmax_W), biases=self.softmax_b,
+                                                      labels=tf.expand_dims(targets, axis=1), inputs=outputs,
+                                                      num_sampled=min(args.num_sampled, args.vocab_size - 1),
+                                                      num_classes=args.vocab_size)
+                loss = tf.reduce_sum(seq_loss) / args.batch_size / args.seq_length
+            else:
+                seq_loss, loss = full_loss, eval_loss
+
+        return logits, seq_loss, loss, eval_loss, final_state
+
+    def _static_rnn(self, inputs: tf.Tensor, initial_state):
+        """Unroll the recurrence into `seq_length` copies of the cell.
+
+        Arguments:
+            inputs {tf.Tensor} -- Input embeddings, shape [batch_size, seq_length, rnn_size].
+            initial_state {tuple} -- Recurrent state at the start of the sequence.
+
+        Returns:
+            {tuple} -- Outputs, shape [batch_size, seq_length, rnn_size] & final state.
+        """
         # Split & reshape inputs.
-        inputs = tf.split(value=inputs, num_or_size_splits=args.seq_length, axis=1)
+        inputs = tf.split(value=inputs, num_or_size_splits=self.args.seq_length, axis=1)
         inputs = [tf.squeeze(input_, axis=[1]) for input_ in inputs]
 
         def loop(prev, _):
@@ -112,97 +307,503 @@ class Model:
                 {tf.Tensor} -- A 2D Tensor of shape [batch_size, input_size] which represents
                 the embedding matrix of the predicted next character.
             """
-            prev = tf.matmul(prev, softmax_W) + softmax_b
+            prev = tf.matmul(prev, self.softmax_W) + self.softmax_b
             prev_symbol = tf.stop_gradient(input=tf.arg_max(prev, dimension=1))
-            return tf.embedding_lookup(embedding, prev_symbol)
+            return tf.embedding_lookup(self.embedding, prev_symbol)
 
         # Decoder.
-        outputs, prev_state = legacy_seq2seq.rnn_decoder(inputs, self.initial_state, cell,
-                                                         loop_function=loop if not training else None,
+        outputs, prev_state = legacy_seq2seq.rnn_decoder(inputs, initial_state, self.cell,
+                                                         loop_function=loop if not self.training else None,
                                                          scope='rnnlm')
 
-        outputs = tf.reshape(tf.concat(outputs, axis=1), shape=[-1, args.rnn_size])
+        return tf.stack(outputs, axis=1), prev_state
 
-        # Fully connected & softmax layer.
-        self.logits = tf.matmul(outputs, softmax_W) + softmax_b
-        self.probs = tf.nn.softmax(self.logits, name="probs")
+    def _fused_lstm(self, inputs: tf.Tensor, initial_state):
+        """Run each LSTM layer over the whole sequence with a single fused kernel.
 
-        # Loss function.
-        with tf.variable_scope('loss'):
-            seq_loss = legacy_seq2seq.sequence_loss_by_example(
-                logits=[self.logits],
-                targets=[tf.reshape(self.targets, shape=[-1])],
-                weights=[tf.ones(shape=[args.batch_size * args.seq_length])])
+        The fused layers reuse the variables of `self.cell` (`LSTMBlockCell`s), which
+        `step` still runs one time step at a time while sampling.
 
-            self.loss = tf.reduce_sum(seq_loss) / args.batch_size / args.seq_length
+        Arguments:
+            inputs {tf.Tensor} -- Input embeddings, shape [batch_size, seq_length, rnn_size].
+            initial_state {tuple} -- Recurrent state at the start of the sequence.
+
+        Returns:
+            {tuple} -- Outputs, shape [batch_size, seq_length, rnn_size] & final state.
+        """
+        args = self.args
+        dropout = self.training and (args.input_keep_prob < 1.0 or args.output_keep_prob < 1.0)
+
+        # Create the variables (& scopes) through the cells `step` uses, once. Not run.
+        with tf.variable_scope('rnnlm'):
+            self.cell(inputs[:, 0], initial_state)
 
-        self.final_state = prev_state
+        # Fused kernels are time major.
+        outputs, final_state = tf.transpose(inputs, perm=[1, 0, 2]), []
 
-        self.lr = tf.Variable(0.0, trainable=False, name="learning_rate")
+        for i, state in enumerate(initial_state):
+            with tf.variable_scope('rnnlm/multi_rnn_cell/cell_{}'.format(i), reuse=True):
+                if dropout:
+                    outputs = tf.nn.dropout(outputs, keep_prob=args.input_keep_prob)
 
-        # Trainable variables & gradient clipping.
-        tvars = tf.trainable_variables()
-        grads, _ = tf.clip_by_global_norm(t_list=tf.gradients(self.loss, tvars),
-                                          clip_norm=args.grad_clip)
+                cell = rnn.LSTMBlockFusedCell(args.rnn_size)
+                outputs, (c, h) = cell(outputs, initial_state=(state.c, state.h), scope='basic_lstm_cell')
 
-        # Optimizer.
-        with tf.variable_scope("optimizer"):
-            self.global_step = tf.Variable(0, trainable=False, name="global_step")
-            optimizer = tf.train.AdamOptimizer(learning_rate=args.learning_rate)
+                if dropout:
+                    outputs = tf.nn.dropout(outputs, keep_prob=args.output_keep_prob)
 
-        # Train ops.
-        self.train_op = optimizer.apply_gradients(grads_and_vars=zip(grads, tvars),
-                                                  global_step=self.global_step,
-                                                  name="train_op")
+            final_state.append(rnn.LSTMStateTuple(c, h))
 
-        # Tensorboard.
-        tf.summary.histogram('logits', self.logits)
-        tf.summary.histogram('seq_loss', seq_loss)
-        tf.summary.scalar('loss', self.loss)
+        return tf.transpose(outputs, perm=[1, 0, 2]), tuple(final_state)
+
+    def build_train_loop(self, iterator):
+        """Build (once) the graph running several training steps in a single `sess.run`.
+
+        Each iteration of a `tf.while_loop` pulls the next batch from the input pipeline,
+        runs the network, applies the clipped gradients & carries the final state over
+        in the state variables, exactly like `train_op`. Iterations run one after the
+        other, each reading the variables updated by the previous one. Requires a
+        stateful model, with `args.steps_per_run` > 1 so its variables are resource variables.
+
+        Arguments:
+            iterator {tf.data.Iterator} -- Iterator of (input_data, targets) batches, see `make_iterator`.
+
+        Raises:
+            ValueError -- Model isn't stateful or wasn't built for several steps per run.
+
+        Returns:
+            {dict} -- Placeholder (steps, defaults to `args.steps_per_run`) and outputs (loss, mean
+                training loss over the steps, summary of it & global_step, read after the steps)
+                of the training loop.
+        """
+        if self._train_loop is not None:
+            return self._train_loop
+
+        if not self.state_variables or self.steps_per_run <= 1:
+            raise ValueError("Training loop requires a stateful model with steps_per_run > 1.")
+
+        args = self.args
+        with tf.name_scope('train_loop'):
+            steps = tf.placeholder_with_default(self.steps_per_run, shape=[], name='steps')
+
+            def step(i, total_loss):
+                # Only start once the previous step's updates are done.
+                with tf.control_dependencies([total_loss]):
+                    input_data, targets = iterator.get_next()
+                    initial_state = nest.pack_sequence_as(self.initial_state,
+                                                          [var.read_value() for var in self.state_variables])
+                input_data.set_shape([args.batch_size, args.seq_length])
+                targets.set_shape([args.batch_size, args.seq_length])
+
+                _, _, loss, _, final_state = self._forward(input_data, targets, initial_state)
+                grads, _ = tf.clip_by_global_norm(t_list=tf.gradients(loss, self._tvars),
+                                                  clip_norm=args.grad_clip)
+                train_op = self._optimizer.apply_gradients(grads_and_vars=zip(grads, self._tvars),
+                                                           global_step=self.global_step)
+
+                with tf.control_dependencies([train_op]):
+                    update_state = tf.group(*[tf.assign(var, state) for var, state in
+                                              zip(self.state_variables, nest.flatten(final_state))])
+                with tf.control_dependencies([update_state]):
+                    return i + 1, total_loss + loss
+
+            _, total_loss = tf.while_loop(lambda i, _: i < steps, step,
+                                          loop_vars=(tf.constant(0), tf.constant(0.)), parallel_iterations=1)
+            loss = total_loss / tf.cast(steps, tf.float32)
+
+            # Only read once every step has been applied.
+            with tf.control_dependencies([total_loss]):
+                global_step = tf.identity(self.global_step.read_value(), name='global_step')
+
+        self._train_loop = {'steps': steps, 'loss': loss, 'global_step': global_step,
+                            'summary': tf.summary.scalar('loss', loss, collections=[])}
+        return self._train_loop
+
+    def step(self, ids: tf.Tensor, state):
+        """Run the network for a single time step, reusing the model's variables.
+
+        Arguments:
+            ids {tf.Tensor} -- Input character ids, shape [batch_size].
+            state {tuple} -- Recurrent state, as given by `self.cell.zero_state`.
+
+        Returns:
+            {tuple} -- Logits of the next character, shape [batch_size, vocab_size] & next state.
+        """
+        inputs = tf.nn.embedding_lookup(self.embedding, ids)
+        with tf.variable_scope('rnnlm', reuse=True):
+            output, state = self.cell(inputs, state)
+
+        logits = tf.matmul(output, self.softmax_W) + self.softmax_b
+        return logits, state
+
+    @staticmethod
+    def encode(vocab: dict, text: str, tokenizer=None):
+        """Ids fed to the network for some text.
+
+        Arguments:
+            vocab {dict} -- Mapping from character to id.
+            text {str} -- Text to be encoded.
+
+        Keyword Arguments:
+            tokenizer {BytePairEncoder} -- Sub-word tokenizer. (default: {None} -- one id per character)
+
+        Raises:
+            KeyError -- Characters of `text` missing from the vocab.
+
+        Returns:
+            {tuple} -- Ids of the characters (or tokens) of `text`.
+        """
+        if tokenizer is not None:
+            return tuple(tokenizer.encode(text).tolist())
+        return tuple(vocab[char] for char in text)
+
+    def build_sampler(self):
+        """Build (once) the graph sampling a batch of sequences entirely inside the runtime.
+
+        Priming & sampling are both `tf.while_loop`s, so sampling `num` characters
+        costs a single `sess.run` & calling it again doesn't add ops to the graph.
+        Primes of different lengths are padded: a row's state only advances while
+        it's still reading its own prime. Rows which sampled the stop character or
+        their own `num` characters are finished: their state is frozen, their outputs
+        padded past their length and the loop ends early once every row is finished.
+
+        Returns:
+            {dict} -- Placeholders (primes, prime_lengths, num (per row, positive), sampling_type,
+                space_id, stop_id), feedable initial_state (zeros by default) and outputs
+                (primed_state, ids, shape [batch, <= max(num)] & lengths, shape [batch]) of the sampler.
+        """
+        if self._sampler is not None:
+            return self._sampler
+
+        with tf.name_scope('sampler'):
+            primes = tf.placeholder(dtype=tf.int32, shape=[None, None], name='primes')
+            prime_lengths = tf.placeholder(dtype=tf.int32, shape=[None], name='prime_lengths')
+            num = tf.placeholder(dtype=tf.int32, shape=[None], name='num')
+            sampling_type = tf.placeholder_with_default(1, shape=[], name='sampling_type')
+            space_id = tf.placeholder_with_default(-1, shape=[], name='space_id')
+            stop_id = tf.placeholder_with_default(-1, shape=[], name='stop_id')
+
+            batch_size = tf.shape(primes)[0]
+            initial_state = self.cell.zero_state(batch_size=batch_size, dtype=tf.float32)
+
+            def select(mask, new, old):
+                """Rows of `new` where `mask` is True, rows of `old` elsewhere, for a whole state."""
+                return nest.map_structure(lambda n, o: tf.where(mask, n, o), new, old)
+
+            # Feed all but the last character of each prime through the network.
+            def prime_step(i, state):
+                _, next_state = self.step(primes[:, i], state)
+                return i + 1, select(i < prime_lengths - 1, next_state, state)
+
+            _, state = tf.while_loop(lambda i, _: i < tf.reduce_max(prime_lengths) - 1, prime_step,
+                                     loop_vars=(tf.constant(0), initial_state))
+            primed_state = state
+
+            # Last character of each prime.
+            last = tf.gather_nd(primes, tf.stack([tf.range(batch_size), prime_lengths - 1], axis=1))
+
+            def sample_step(i, prev, state, finished, lengths, ids):
+                logits, next_state = self.step(prev, state)
+
+                # 0: argmax, 2: sample after a space & argmax otherwise, else: sample.
+                greedy = tf.argmax(logits, axis=1, output_type=tf.int32)
+                sampled = tf.cast(tf.multinomial(logits, num_samples=1)[:, 0], tf.int32)
+                use_sampled = tf.logical_not(tf.logical_or(
+                    tf.equal(sampling_type, 0),
+                    tf.logical_and(tf.equal(sampling_type, 2), tf.not_equal(prev, space_id))))
+                pred = tf.where(use_sampled, sampled, greedy)
+
+                # Finished rows keep their state & are padded with their last id.
+                pred = tf.where(finished, prev, pred)
+                state = select(finished, state, next_state)
+                lengths += tf.cast(tf.logical_not(finished), tf.int32)
+                finished = tf.logical_or(finished, tf.logical_or(tf.equal(pred, stop_id), lengths >= num))
+
+                return i + 1, pred, state, finished, lengths, ids.write(i, pred)
+
+            def sample_cond(i, prev, state, finished, *_):
+                return tf.logical_and(i < tf.reduce_max(num), tf.logical_not(tf.reduce_all(finished)))
+
+            _, _, _, _, lengths, ids = tf.while_loop(
+                sample_cond, sample_step,
+                loop_vars=(tf.constant(0), last, state, tf.zeros([batch_size], dtype=tf.bool),
+                           tf.zeros([batch_size], dtype=tf.int32),
+                           tf.TensorArray(dtype=tf.int32, size=0, dynamic_size=True)))
+
+        self._sampler = {'primes': primes, 'prime_lengths': prime_lengths, 'num': num,
+                         'sampling_type': sampling_type, 'space_id': space_id, 'stop_id': stop_id,
+                         'initial_state': initial_state, 'primed_state': primed_state,
+                         'ids': tf.transpose(ids.stack()), 'lengths': lengths}
+        return self._sampler
+
+    def sample_batch(self, sess: tf.Session, chars: tuple, vocab: dict, primes: list,
+                     num=200, sampling_type: int = 1, stop: str = None, cache=None, tokenizer=None):
+        """Sample continuations of several primes at once, in a single `sess.run`.
+
+        Arguments:
+            sess {tf.Session} -- Session containing the default graph.
+            chars {tuple} -- List of characters in the vocab.
+            vocab {dict} -- Mapping from character to id.
+            primes {list} -- Beginnings of the prediction sequences, of any (non-zero) lengths.
+
+        Keyword Arguments:
+            num {int|list} -- Maximum number of characters to predict per prime, or a list of
+                one maximum per prime. Rows stop sampling at their own maximum. (default: {200})
+            sampling_type {int} -- How to choose the next character, as in `sample`. (default: {1})
+            stop {str} -- Character ending a sequence once sampled; kept in its output.
+                (default: {None} -- always sample `num` characters)
+            cache {PrefixStateCache} -- Cache of primed states. Only the part of each prime
+                past its longest cached prefix is fed through the network. (default: {None})
+            tokenizer {BytePairEncoder} -- Sub-word tokenizer the model was trained with, `chars`
+                being the text of its tokens & `num` counting tokens. (default: {None} -- characters)
+
+        Returns:
+            {list} -- Each prime followed by its predicted characters.
+        """
+        sampler = self.build_sampler()
+        nums = list(num) if isinstance(num, (list, tuple)) else [num] * len(primes)
+        prime_ids = [self.encode(vocab, prime, tokenizer=tokenizer) for prime in primes]
+
+        # Start each row from the state of its longest cached prefix, if any.
+        starts, states = [0] * len(primes), []
+        if cache is not None:
+            zero_state = sess.run(self._zero_state)
+            for row, ids in enumerate(prime_ids):
+                starts[row], state = cache.lookup(ids[:-1])
+                states.append(zero_state if state is None else state)
+
+        # Pad the rest of the primes to the longest one.
+        lengths = [len(ids) - start for ids, start in zip(prime_ids, starts)]
+        padded = np.zeros(shape=(len(primes), max(lengths)), dtype=np.int32)
+        for row, (ids, start) in enumerate(zip(prime_ids, starts)):
+            padded[row, :lengths[row]] = ids[start:]
+
+        feed_dict = {sampler['primes']: padded,
+                     sampler['prime_lengths']: lengths,
+                     sampler['num']: nums,
+                     sampler['sampling_type']: sampling_type,
+                     sampler['space_id']: vocab.get(' ', -1),
+                     sampler['stop_id']: -1 if stop is None else vocab[stop]}
+
+        if cache is None:
+            ids, lengths = sess.run([sampler['ids'], sampler['lengths']], feed_dict=feed_dict)
+        else:
+            feed_dict[sampler['initial_state']] = nest.map_structure(lambda *rows: np.concatenate(rows), *states)
+            ids, lengths, primed_state = sess.run([sampler['ids'], sampler['lengths'], sampler['primed_state']],
+                                                  feed_dict=feed_dict)
+
+            # Copies of each row: a view would keep the whole batch alive, past the cache's byte bound.
+            for row, prime in enumerate(prime_ids):
+                cache.insert(prime[:-1], nest.map_structure(lambda s: np.array(s[row:row + 1]), primed_state))
+
+        return [prime + ''.join(chars[i] for i in row[:length]) for prime, row, length in zip(primes, ids, lengths)]
+
+    def build_beam_search(self):
+        """Build (once) the graph running a beam search decoder inside the runtime.
+
+        After priming, the state is tiled over the beam. Every step expands all
+        hypotheses at once: their scores are added to the log-probabilities of every
+        character & the `beam_width` best of the [beam_width * vocab_size] candidates
+        are kept with a single `tf.nn.top_k`, with parents' states & histories
+        gathered by index. Hypotheses ending with the stop character are finished and
+        only carried along. Final scores are normalized by the GNMT length penalty
+        ((5 + length) / 6) ** length_penalty.
+
+        Returns:
+            {dict} -- Placeholders (prime, num, beam_width, length_penalty, stop_id) and
+                outputs (ids, shape [beam_width, <= num], lengths & scores, shape [beam_width],
+                best hypothesis first) of the beam search.
+        """
+        if self._beam_search is not None:
+            return self._beam_search
+
+        with tf.name_scope('beam_search'):
+            prime = tf.placeholder(dtype=tf.int32, shape=[None], name='prime')
+            num = tf.placeholder(dtype=tf.int32, shape=[], name='num')
+            beam_width = tf.placeholder_with_default(5, shape=[], name='beam_width')
+            length_penalty = tf.placeholder_with_default(0.6, shape=[], name='length_penalty')
+            stop_id = tf.placeholder_with_default(-1, shape=[], name='stop_id')
+
+            # Feed all but the last character of the prime through the network.
+            def prime_step(i, state):
+                _, state = self.step(prime[i:i + 1], state)
+                return i + 1, state
+
+            _, state = tf.while_loop(lambda i, _: i < tf.size(prime) - 1, prime_step,
+                                     loop_vars=(tf.constant(0), self._zero_state))
+
+            # Every hypothesis starts from the primed state, but only the first one is
+            # alive at first, so the first expansion doesn't pick duplicates.
+            state = nest.map_structure(lambda s: tf.tile(s, [beam_width, 1]), state)
+            scores = tf.concat([[0.], tf.fill([beam_width - 1], -np.inf)], axis=0)
+            prev = tf.tile(prime[-1:], [beam_width])
+
+            vocab_size = self.args.vocab_size
+            # Log-probabilities continuing a finished hypothesis: the stop id, for free.
+            finished_log_probs = tf.where(tf.equal(tf.range(vocab_size), stop_id),
+                                          tf.zeros([vocab_size]), tf.fill([vocab_size], -np.inf))
+
+            def beam_step(i, prev, state, scores, finished, lengths, history):
+                logits, state = self.step(prev, state)
+                log_probs = tf.where(finished, tf.tile(finished_log_probs[None], [beam_width, 1]),
+                                     tf.nn.log_softmax(logits))
+
+                # Expand & prune every hypothesis at once.
+                candidates = tf.reshape(scores[:, None] + log_probs, shape=[-1])
+                scores, indices = tf.nn.top_k(candidates, k=beam_width)
+                parents, pred = indices // vocab_size, indices % vocab_size
+
+                state = nest.map_structure(lambda s: tf.gather(s, parents), state)
+                history = tf.concat([tf.gather(history, parents), pred[:, None]], axis=1)
+                finished = tf.gather(finished, parents)
+                lengths = tf.gather(lengths, parents) + tf.cast(tf.logical_not(finished), tf.int32)
+                finished = tf.logical_or(finished, tf.equal(pred, stop_id))
+
+                return i + 1, pred, state, scores, finished, lengths, history
+
+            def beam_cond(i, prev, state, scores, finished, *_):
+                return tf.logical_and(i < num, tf.logical_not(tf.reduce_all(finished)))
+
+            loop_vars = (tf.constant(0), prev, state, scores, tf.zeros([beam_width], dtype=tf.bool),
+                         tf.zeros([beam_width], dtype=tf.int32), tf.zeros([beam_width, 0], dtype=tf.int32))
+            shape_invariants = nest.map_structure(lambda t: t.get_shape(), loop_vars[:-1])
+            _, _, _, scores, _, lengths, history = tf.while_loop(
+                beam_cond, beam_step, loop_vars=loop_vars,
+                shape_invariants=shape_invariants + (tf.TensorShape([None, None]),))
+
+            # Length normalized scores, best hypothesis first.
+            penalty = tf.pow((5. + tf.cast(lengths, tf.float32)) / 6., length_penalty)
+            scores, order = tf.nn.top_k(scores / penalty, k=beam_width)
+
+        self._beam_search = {'prime': prime, 'num': num, 'beam_width': beam_width,
+                             'length_penalty': length_penalty, 'stop_id': stop_id,
+                             'ids': tf.gather(history, order), 'lengths': tf.gather(lengths, order),
+                             'scores': scores}
+        return self._beam_search
+
+    def beam_search(self, sess: tf.Session, chars: tuple, vocab: dict, num: int = 200, prime: str = 'The',
+                    beam_width: int = 5, length_penalty: float = 0.6, stop: str = None, tokenizer=None):
+        """Decode the most likely continuations of `prime` with beam search.
+
+        Arguments:
+            sess {tf.Session} -- Session containing the default graph.
+            chars {tuple} -- List of characters in the vocab.
+            vocab {dict} -- Mapping from character to id.
+
+        Keyword Arguments:
+            num {int} -- Maximum number of characters to predict. (default: {200})
+            prime {str} -- Beginning of prediction sequence. (default: {'The'})
+            beam_width {int} -- Number of hypotheses kept at every step. (default: {5})
+            length_penalty {float} -- Exponent of the length normalization; 0 disables it. (default: {0.6})
+            stop {str} -- Character ending a hypothesis; kept in its output.
+                (default: {None} -- always predict `num` characters)
+            tokenizer {BytePairEncoder} -- Sub-word tokenizer, as in `sample_batch`. (default: {None})
+
+        Returns:
+            {list} -- `beam_width` (sequence, normalized log-probability score) pairs, best first.
+        """
+        beam_search = self.build_beam_search()
+        ids, lengths, scores = sess.run([beam_search['ids'], beam_search['lengths'], beam_search['scores']],
+                                        feed_dict={beam_search['prime']: self.encode(vocab, prime, tokenizer=tokenizer),
+                                                   beam_search['num']: num,
+                                                   beam_search['beam_width']: beam_width,
+                                                   beam_search['length_penalty']: length_penalty,
+                                                   beam_search['stop_id']: -1 if stop is None else vocab[stop]})
+
+        return [(prime + ''.join(chars[i] for i in row[:length]), score)
+                for row, length, score in zip(ids, lengths, scores)]
 
     def sample(self, sess: tf.Session, chars: tuple, vocab: dict,
-               num: int = 200, prime: str = 'The', sampling_type: int = 1):
+               num: int = 200, prime: str = 'The', sampling_type: int = 1, in_graph: bool = False, cache=None,
+               tokenizer=None):
         """Sample from the prediction probability one character at a time.
 
         Arguments:
             sess {tf.Session} -- Session containing the default graph.
             chars {tuple} -- List of characters in the vocab.
-            vocab {dict} -- Mapping from character to id. Dictionary containing characters & corresponding numeric
-            value.
+            vocab {dict} -- Mapping from character to id.
+
+        Keyword Arguments:
+            num {int} -- Number of characters to predict. (default: {200})
+            prime {str} -- Beginning of prediction sequence. (default: {'The'})
+            sampling_type {int} -- How to choose the next character. 0: most likely, 2: sampled after
+                a space & most likely otherwise, any other value: sampled. (default: {1})
+            in_graph {bool} -- Run the whole priming & sampling loop inside the graph with a single
+                `sess.run`. (default: {False})
+            cache {PrefixStateCache} -- Cache of primed states, so only the uncached suffix of
+                `prime` is fed. (default: {None})
+            tokenizer {BytePairEncoder} -- Sub-word tokenizer, as in `sample_batch`. (default: {None})
+
+        Returns:
+            {str} -- `prime` followed by the `num` predicted characters.
+        """
+
+        if in_graph:
+            return self.sample_batch(sess, chars, vocab, [prime], num=num, sampling_type=sampling_type,
+                                     cache=cache, tokenizer=tokenizer)[0]
+
+        # Accumulate in a list & join once, rather than growing a string.
+        ret = [prime]
+        ret.extend(self.generate(sess, chars, vocab, num=num, prime=prime,
+                                 sampling_type=sampling_type, cache=cache, tokenizer=tokenizer))
+        return ''.join(ret)
 
-        Keyword Arguments: num {int} -- Number of character to predict. (default: {200}) prime {str} -- Beginning of
-        prediction sequence. (default: {'The'}) sampling_type {int} -- Description of how to choose the top most
-        likely character. Options are 1, 2, & 3. (default: {1})
+    def generate(self, sess: tf.Session, chars: tuple, vocab: dict, num: int = 200, prime: str = 'The',
+                 sampling_type: int = 1, cache=None, chunk_size: int = 1, tokenizer=None):
+        """Stream predicted characters as they're sampled, one `sess.run` per character.
 
-         Returns:
-             ret {str} -- Sequence containing the prediction of the `num` characters.
+        Arguments:
+            sess {tf.Session} -- Session containing the default graph.
+            chars {tuple} -- List of characters in the vocab.
+            vocab {dict} -- Mapping from character to id.
+
+        Keyword Arguments:
+            num {int} -- Number of characters to predict. (default: {200})
+            prime {str} -- Beginning of prediction sequence; not yielded. (default: {'The'})
+            sampling_type {int} -- How to choose the next character, as in `sample`. (default: {1})
+            cache {PrefixStateCache} -- Cache of primed states, so only the uncached suffix of
+                `prime` is fed. (default: {None})
+            chunk_size {int} -- Number of characters yielded at a time. (default: {1})
+            tokenizer {BytePairEncoder} -- Sub-word tokenizer, as in `sample_batch`. Chunks are then
+                made of `chunk_size` tokens. (default: {None})
+
+        Yields:
+            {str} -- Next `chunk_size` predicted characters (fewer for the last chunk).
         """
+        # Input data: one char at a time.
+        x = np.zeros(shape=(1, 1))
+
+        ids = self.encode(vocab, prime, tokenizer=tokenizer)
+
+        # Initial cell state: the state of the longest cached prefix of the prime, if any.
+        start, state = (0, None) if cache is None else cache.lookup(ids[:-1])
+        if state is None:
+            state = sess.run(self._zero_state)
 
-        # Initial cell state. TODO: Change dtype=tf.float32
         # Predict final state given input data & prev state.
-        state = sess.run(self.cell.zero_state(batch_size=1, dtype=tf.float32))
-        for char in prime[:-1]:
-            # Input data: one char at a time.
-            x = np.zeros(shape=(1, 1))
-            x[0, 0] = vocab[char]
+        for id_ in ids[start:-1]:
+            x[0, 0] = id_
 
             # Given input data & initial state, predict final state.
             feed_dict = {self.input_data: x, self.initial_state: state}
             [state] = sess.run([self.final_state], feed_dict=feed_dict)
 
+        if cache is not None:
+            cache.insert(ids[:-1], state)
+
         def weighted_pick(weights):
             c = np.cumsum(weights)
             s = np.sum(weights)
             return int(np.searchsorted(c, np.random.rand(1) * s))
 
-        # Initial character.
-        ret = prime
-        char = prime[-1]
+        # Initial character & buffer of characters not yielded yet.
+        sample = ids[-1]
+        char = chars[sample]
+        buffer = []
 
         # Prediction loop.
         for i in range(num):
-            x = np.zeros(shape=(1, 1))
-            x[0, 0] = vocab[char]
+            x[0, 0] = sample
 
             # Predict probability of next word & prev state.
             feed_dict = {self.input_data: x, self.initial_state: state}
@@ -221,8 +822,12 @@ class Model:
                 sample = weighted_pick(p)
 
             # Get the character representation of sampled character.
-            pred = chars[sample]
-            ret += pred
-            char = pred
+            char = chars[sample]
+            buffer.append(char)
+
+            if len(buffer) >= chunk_size:
+                yield ''.join(buffer)
+                buffer = []
 
-        return ret
+        if buffer:
+            yield ''.join(buffer)
@@ -0,0 +1,328 @@
+# Backward compatibility with Python 2.
+from __future__ import print_function, absolute_import, division
+
+# Suppress all warnings.
+import warnings
+
+warnings.filterwarnings('ignore')
+
+import os
+import json
+import time
+import queue
+import pickle
+import argparse
+import threading
+import collections
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import tensorflow as tf
+
+from model import Model
+from cache import PrefixStateCache
+from utils import BytePairEncoder
+
+
+def main():
+    # Argument parser.
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    # Command line arguments.
+    parser.add_argument('--save_dir', type=str, default='saved',
+                        help='Directory containing config.pkl, chars_vocab.pkl & checkpoints.')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Address the server listens on.')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='Port the server listens on. 0 picks a free port.')
+    parser.add_argument('--max_batch', type=int, default=32,
+                        help='Maximum number of requests generated together.')
+    parser.add_argument('--batch_window_ms', type=float, default=5.,
+                        help='How long to wait for more requests to batch with the first one.')
+    parser.add_argument('--cache_entries', type=int, default=128,
+                        help='Maximum number of primed states cached.')
+    parser.add_argument('--cache_mb', type=float, default=64.,
+                        help='Maximum total size of the primed states cached, in MiB.')
+
+    # Parse the arguments.
+    args = parser.parse_args()
+
+    server = serve(args)
+    print('Serving on http://{}:{}'.format(*server.server_address))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\nShutting down...')
+    finally:
+        server.server_close()
+        server.batcher.close()
+
+
+def load_model(save_dir: str):
+    """Build the sampling model & restore its latest checkpoint, once.
+
+    Arguments:
+        save_dir {str} -- Directory containing config.pkl, chars_vocab.pkl & checkpoints.
+
+    Returns:
+        {tuple} -- Session, model, chars, vocab & sub-word tokenizer (or None).
+    """
+    with open(os.path.join(save_dir, 'config.pkl'), mode='rb') as f:
+        saved_args = pickle.load(f)
+
+    with open(os.path.join(save_dir, 'chars_vocab.pkl'), mode='rb') as f:
+        chars, vocab = pickle.load(f)
+
+    # Sub-word tokenizer, saved by models trained on byte-pair encoded text.
+    tokenizer = None
+    if os.path.exists(os.path.join(save_dir, 'bpe.pkl')):
+        with open(os.path.join(save_dir, 'bpe.pkl'), mode='rb') as f:
+            bpe = pickle.load(f)
+        if bpe is not None:
+            tokenizer = BytePairEncoder(*bpe)
+
+    model = Model(saved_args, training=False)
+    model.build_sampler()
+
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+
+    ckpt = tf.train.get_checkpoint_state(save_dir)
+    assert ckpt and ckpt.model_checkpoint_path, "No checkpoint found in {}".format(save_dir)
+    tf.train.Saver(var_list=tf.global_variables()).restore(sess=sess, save_path=ckpt.model_checkpoint_path)
+
+    return sess, model, chars, vocab, tokenizer
+
+
+class Request:
+    """Generation request waiting to be batched.
+
+    Arguments:
+        prime {str} -- Beginning of the prediction sequence.
+        num {int} -- Number of characters (or tokens) to predict.
+        sampling_type {int} -- How to choose the next character, as in `Model.sample`.
+        stop {str} -- Character ending the sequence once sampled, or None.
+    """
+
+    def __init__(self, prime: str, num: int, sampling_type: int, stop: str):
+        self.prime = prime
+        self.num = num
+        self.sampling_type = sampling_type
+        self.stop = stop
+
+        self.text = None
+        self.error = None
+        self.done = threading.Event()
+        self.created = time.time()
+        self.latency = None
+
+
+class Batcher:
+    """Coalesce concurrent generation requests into batches run by a single worker thread.
+
+    The worker waits for a request, then for up to `window` seconds for more, and
+    generates each group of requests sharing a sampling type & stop character with
+    one `Model.sample_batch` call.
+
+    Arguments:
+        sess {tf.Session} -- Session holding the restored model.
+        model {Model} -- Sampling model.
+        chars {tuple} -- List of characters in the vocab.
+        vocab {dict} -- Mapping from character to id.
+
+    Keyword Arguments:
+        tokenizer {BytePairEncoder} -- Sub-word tokenizer the model was trained with. (default: {None})
+        max_batch {int} -- Maximum number of requests per batch. (default: {32})
+        window {float} -- Batching window, in seconds. (default: {0.005})
+        cache {PrefixStateCache} -- Cache of primed states. (default: {None})
+        history {int} -- Number of latest request latencies kept for percentiles. (default: {10000})
+    """
+
+    def __init__(self, sess: tf.Session, model: Model, chars: tuple, vocab: dict, tokenizer=None,
+                 max_batch: int = 32, window: float = 0.005, cache: PrefixStateCache = None,
+                 history: int = 10000):
+        self.sess = sess
+        self.model = model
+        self.chars = chars
+        self.vocab = vocab
+        self.tokenizer = tokenizer
+        self.max_batch = max_batch
+        self.window = window
+        self.cache = cache
+
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen=history)
+        self.num_requests = 0
+        self.num_batches = 0
+
+        self._lock = threading.Lock()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='Batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, request: Request):
+        """Queue a request & block until it has been generated.
+
+        Arguments:
+            request {Request} -- Request to be generated.
+
+        Returns:
+            {Request} -- The same request, with its text (or error) & latency set.
+        """
+        self.requests.put(request)
+        request.done.wait()
+        return request
+
+    def _next_batch(self):
+        """Wait for a request & collect the ones arriving within the batching window."""
+        batch = [self.requests.get()]
+        deadline = time.time() + self.window
+
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return [request for request in batch if request is not None]
+
+    def _run(self):
+        """Worker loop: generate batches of requests until closed."""
+        while self._running:
+            batch = self._next_batch()
+
+            # Requests sampled the same way are generated together.
+            groups = collections.defaultdict(list)
+            for request in batch:
+                groups[request.sampling_type, request.stop].append(request)
+
+            for (sampling_type, stop), requests in groups.items():
+                try:
+                    texts = self.model.sample_batch(self.sess, self.chars, self.vocab,
+                                                    [request.prime for request in requests],
+                                                    num=[request.num for request in requests],
+                                                    sampling_type=sampling_type, stop=stop, cache=self.cache,
+                                                    tokenizer=self.tokenizer)
+                except Exception as e:
+                    texts = [None] * len(requests)
+                    for request in requests:
+                        request.error = str(e)
+
+                now = time.time()
+                with self._lock:
+                    self.num_batches += 1
+                    for request, text in zip(requests, texts):
+                        request.text = text
+                        request.latency = now - request.created
+                        self.latencies.append(request.latency)
+                        self.num_requests += 1
+
+                for request in requests:
+                    request.done.set()
+
+    def stats(self):
+        """Request & batch counters and latency percentiles.
+
+        Returns:
+            {dict} -- requests, batches, mean_batch_size, latency_ms (p50, p90, p99, max) & cache.
+        """
+        with self._lock:
+            latencies = np.array(self.latencies) * 1000.
+            stats = {'requests': self.num_requests, 'batches': self.num_batches,
+                     'mean_batch_size': self.num_requests / max(self.num_batches, 1)}
+
+        if latencies.size:
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+            stats['latency_ms'] = {'p50': p50, 'p90': p90, 'p99': p99, 'max': latencies.max()}
+
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+
+        return stats
+
+    def close(self):
+        """Stop the worker thread once the requests already queued are generated."""
+        self._running = False
+        self.requests.put(None)
+        self._thread.join()
+
+
+class GenerationHandler(BaseHTTPRequestHandler):
+    """HTTP endpoints.
+
+    POST /generate -- JSON body {"prime": str, "num": int, "sampling_type": int, "stop": str},
+        only "prime" is required. Responds with {"text": str, "latency_ms": float}.
+    GET /stats -- Batcher statistics, see `Batcher.stats`.
+    """
+
+    def _reply(self, code: int, body: dict):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self._reply(404, {'error': 'Not found.'})
+        self._reply(200, self.server.batcher.stats())
+
+    def do_POST(self):
+        if self.path != '/generate':
+            return self._reply(404, {'error': 'Not found.'})
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            request = Request(prime=body['prime'], num=int(body.get('num', 200)),
+                              sampling_type=int(body.get('sampling_type', 1)), stop=body.get('stop'))
+        except (ValueError, KeyError, TypeError) as e:
+            return self._reply(400, {'error': 'Invalid request: {}'.format(e)})
+
+        if request.num <= 0:
+            return self._reply(400, {'error': 'num must be positive, got {}.'.format(request.num)})
+
+        vocab = self.server.batcher.vocab
+        if request.stop is not None and request.stop not in vocab:
+            return self._reply(400, {'error': 'stop must be a single vocab entry, got {!r}.'.format(request.stop)})
+
+        unknown = set(request.prime) - set(vocab)
+        if not request.prime or unknown:
+            return self._reply(400, {'error': 'Empty prime or characters not in vocab: {!r}'.format(sorted(unknown))})
+
+        self.server.batcher.submit(request)
+        if request.error is not None:
+            return self._reply(500, {'error': request.error})
+
+        self._reply(200, {'text': request.text, 'latency_ms': request.latency * 1000.})
+
+    def log_message(self, format, *args):
+        # Keep the console for the server's own messages.
+        pass
+
+
+def serve(args):
+    """Load the model once & create the HTTP server (not started yet).
+
+    Arguments:
+        args {argparse.Namespace} -- Command line arguments, see `main`.
+
+    Returns:
+        {ThreadingHTTPServer} -- Server, with its `batcher` attached.
+    """
+    sess, model, chars, vocab, tokenizer = load_model(args.save_dir)
+    cache = PrefixStateCache(max_entries=args.cache_entries, max_bytes=int(args.cache_mb * (1 << 20)))
+
+    server = ThreadingHTTPServer((args.host, args.port), GenerationHandler)
+    server.batcher = Batcher(sess, model, chars, vocab, tokenizer=tokenizer, max_batch=args.max_batch,
+                             window=args.batch_window_ms / 1000., cache=cache)
+    return server
+
+
+if __name__ == '__main__':
+    main()
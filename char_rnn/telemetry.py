@@ -0,0 +1,149 @@
+"""Training summaries fetched at separate cadences & written on a background thread."""
+
+import time
+import queue
+import collections
+import threading
+
+import tensorflow as tf
+
+
+class Telemetry:
+    """Fetch cheap scalar & costly histogram summaries at their own cadences.
+
+    Scalars (e.g. the loss) are fetched every `scalar_every` steps and histograms (e.g. of
+    the logits of the whole batch) every `histogram_every` steps, in the same session call
+    as the training step. The serialized summaries are handed over to a writer thread, so
+    parsing & writing the events doesn't stall training.
+
+    Step times are accounted per set of summary kinds fetched (none, scalars, scalars &
+    histograms, ...). Instrumentation overhead is the extra time of every set over the mean
+    step time of the cheapest set seen, plus the time spent handing the summaries over.
+    Without any step fetching no summary (e.g. scalars every step), the cheapest set is the
+    baseline & its own cost isn't accounted.
+
+    Arguments:
+        writer {tf.summary.FileWriter} -- Writer of the event files.
+
+    Keyword Arguments:
+        scalars {tf.Tensor} -- Merged scalar summaries. (default: {None})
+        histograms {tf.Tensor} -- Merged histogram summaries. (default: {None})
+        scalar_every {int} -- Scalar cadence, in steps. 0 disables them. (default: {1})
+        histogram_every {int} -- Histogram cadence, in steps. 0 disables them. (default: {100})
+        queue_size {int} -- Maximum number of summaries waiting to be written. (default: {100})
+    """
+
+    def __init__(self, writer: tf.summary.FileWriter, scalars: tf.Tensor = None, histograms: tf.Tensor = None,
+                 scalar_every: int = 1, histogram_every: int = 100, queue_size: int = 100):
+        self.writer = writer
+        self.cadences = {'scalars': (scalars, scalar_every), 'histograms': (histograms, histogram_every)}
+
+        # Number & time of the steps run, by sorted tuple of the summary kinds fetched.
+        self.steps = collections.Counter()
+        self.step_time = collections.Counter()
+        self.handover_time = 0.
+        self.write_time = 0.
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._write, name='Telemetry', daemon=True)
+        self._thread.start()
+
+    def fetches(self, step: int, steps: int = 1):
+        """Summaries due at any of the `steps` training steps starting at `step`.
+
+        Arguments:
+            step {int} -- First training step of the session call.
+
+        Keyword Arguments:
+            steps {int} -- Number of training steps run by the session call. (default: {1})
+
+        Returns:
+            {dict} -- Summary tensors to fetch along with the training step, by kind.
+        """
+        return {kind: summary for kind, (summary, every) in self.cadences.items()
+                if summary is not None and every > 0 and -step % every < steps}
+
+    def record(self, results: dict, global_step: int, duration: float, steps: int = 1):
+        """Queue the fetched summaries & account for the step time.
+
+        Arguments:
+            results {dict} -- Fetched values of `fetches`.
+            global_step {int} -- Step the summaries are recorded at.
+            duration {float} -- Time of the session call, in seconds.
+
+        Keyword Arguments:
+            steps {int} -- Number of training steps run by the session call. (default: {1})
+        """
+        start = time.time()
+        for summary in results.values():
+            self._queue.put((summary, global_step))
+        self.handover_time += time.time() - start
+
+        kinds = tuple(sorted(results))
+        self.steps[kinds] += steps
+        self.step_time[kinds] += duration
+
+    def _write(self):
+        """Writer loop: parse & write summaries until closed."""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            start = time.time()
+            summary, global_step = item
+            self.writer.add_summary(summary=summary, global_step=global_step)
+            self.write_time += time.time() - start
+
+    @property
+    def baseline(self):
+        """Set of summary kinds fetched by the steps with the lowest mean time.
+
+        Returns:
+            {tuple} -- Sorted summary kinds, empty for steps without summaries, or None before any step.
+        """
+        if not self.steps:
+            return None
+        return min(self.steps, key=lambda kinds: self.step_time[kinds] / self.steps[kinds])
+
+    @property
+    def overhead(self):
+        """Step time spent on instrumentation, in seconds.
+
+        Returns:
+            {float} -- Extra time of every set of summary kinds over the baseline & handover time.
+        """
+        extra = 0.
+        baseline = self.baseline
+        if baseline is not None:
+            mean = self.step_time[baseline] / self.steps[baseline]
+            extra = sum(max(self.step_time[kinds] - mean * steps, 0.) for kinds, steps in self.steps.items())
+        return extra + self.handover_time
+
+    def stats(self):
+        """Instrumentation accounting.
+
+        Returns:
+            {dict} -- steps, instrumented_steps, step_time, overhead (s), overhead_ratio (of the
+                step time), baseline (summary kinds the overhead is relative to) & write_time
+                (s, on the writer thread).
+        """
+        step_time = sum(self.step_time.values())
+        return {'steps': sum(self.steps.values()), 'instrumented_steps': sum(steps for kinds, steps in
+                                                                             self.steps.items() if kinds),
+                'step_time': step_time, 'overhead': self.overhead,
+                'overhead_ratio': self.overhead / step_time if step_time else 0.,
+                'baseline': self.baseline, 'write_time': self.write_time}
+
+    def close(self):
+        """Write the summaries still queued & flush the writer."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self.writer.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,104 @@
+"""Opt-in tracing of training steps: Chrome timelines, TensorBoard run metadata & op type costs."""
+
+import os
+import collections
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+class StepTracer:
+    """Trace every `every`-th training step with full run metadata.
+
+    A traced step writes a Chrome trace (`timeline-<step>.json` in `logdir`, open it in
+    chrome://tracing) and, given a writer, its run metadata for TensorBoard's graph view.
+    The time of every op is also aggregated by op type over all the traced steps.
+
+    Arguments:
+        logdir {str} -- Directory the timelines are written to.
+
+    Keyword Arguments:
+        every {int} -- Tracing cadence, in steps. 0 disables tracing. (default: {0})
+        writer {tf.summary.FileWriter} -- Writer of the run metadata. (default: {None})
+    """
+
+    def __init__(self, logdir: str, every: int = 0, writer: tf.summary.FileWriter = None):
+        self.logdir = logdir
+        self.every = every
+        self.writer = writer
+
+        # Number of ops & total time (in microseconds) by op type.
+        self.op_types = collections.defaultdict(lambda: [0, 0])
+        self.traced_steps = 0
+
+    def options(self, step: int, steps: int = 1):
+        """Run options & metadata of a session call, if one of its steps is due for tracing.
+
+        Arguments:
+            step {int} -- First training step of the session call.
+
+        Keyword Arguments:
+            steps {int} -- Number of training steps run by the session call. (default: {1})
+
+        Returns:
+            {tuple} -- `tf.RunOptions` & `tf.RunMetadata` to pass to `sess.run`, or (None, None).
+        """
+        if self.every <= 0 or -step % self.every >= steps:
+            return None, None
+        return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+
+    def record(self, run_metadata: tf.RunMetadata, step: int):
+        """Write the timeline & run metadata of a traced step and aggregate its op costs.
+
+        Arguments:
+            run_metadata {tf.RunMetadata} -- Metadata filled in by `sess.run`, or None if not traced.
+            step {int} -- Step the trace is recorded at.
+        """
+        if run_metadata is None:
+            return
+
+        if not tf.gfile.Exists(self.logdir):
+            tf.gfile.MakeDirs(self.logdir)
+
+        trace = timeline.Timeline(step_stats=run_metadata.step_stats)
+        with open(os.path.join(self.logdir, 'timeline-{}.json'.format(step)), mode='w') as f:
+            f.write(trace.generate_chrome_trace_format())
+
+        if self.writer is not None:
+            self.writer.add_run_metadata(run_metadata, tag='step{}'.format(step), global_step=step)
+
+        for device in run_metadata.step_stats.dev_stats:
+            # GPU kernels are listed once per stream & again for all streams.
+            if 'stream:' in device.device and not device.device.endswith('stream:all'):
+                continue
+
+            for node in device.node_stats:
+                # Labels read "name = OpType(inputs)", except for some internal nodes.
+                label = node.timeline_label
+                op_type = label.split(' = ')[1].split('(')[0] if ' = ' in label else node.node_name
+                self.op_types[op_type][0] += 1
+                self.op_types[op_type][1] += node.all_end_rel_micros
+
+        self.traced_steps += 1
+
+    def summary(self, top: int = 15):
+        """Table of the costliest op types over the traced steps.
+
+        Keyword Arguments:
+            top {int} -- Number of op types listed. (default: {15})
+
+        Returns:
+            {str} -- Op types with their count, total & mean time per traced step and share of the time.
+        """
+        if not self.traced_steps:
+            return 'No step traced.'
+
+        total = max(sum(micros for _, micros in self.op_types.values()), 1)
+        lines = ['Op types over {:,} traced step(s):'.format(self.traced_steps),
+                 '{:<32} {:>8} {:>12} {:>8}'.format('op type', 'count', 'ms/step', 'share')]
+        costs = sorted(self.op_types.items(), key=lambda item: item[1][1], reverse=True)
+        for op_type, (count, micros) in costs[:top]:
+            lines.append('{:<32} {:>8,} {:>12.3f} {:>8.1%}'.format(op_type[:32], count // self.traced_steps,
+                                                                   micros / 1000. / self.traced_steps,
+                                                                   micros / total))
+        return '\n'.join(lines)
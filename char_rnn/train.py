@@ -9,12 +9,17 @@ warnings.filterwarnings('ignore')
 import os
 import time
 import pickle
+import signal
 import argparse
 
 import tensorflow as tf
+from tensorflow.contrib.framework import nest
 
-from utils import TextLoader
-from model import Model
+from utils import TextLoader, BatchPrefetcher
+from model import Model, make_iterator
+from checkpoint import AsyncCheckpointer
+from telemetry import Telemetry
+from tracing import StepTracer
 
 # tf.enable_eager_execution()
 
@@ -26,22 +31,63 @@ def main():
     # Command line arguments.
     parser.add_argument('--data_dir', type=str, default='datasets/pycode',
                         help='Data directory containing input.txt')
+    parser.add_argument('--input_pattern', type=str, default='input.txt',
+                        help='Glob of text shards (relative to data_dir) making up the corpus.')
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help='Number of processes used to pre-process text shards. Defaults to CPU count.')
+    parser.add_argument('--chunk_size', type=int, default=None,
+                        help='Stream input.txt in chunks of this many characters while pre-processing.')
+    parser.add_argument('--shuffle', action='store_true',
+                        help='Shuffle the order of batch blocks every epoch.')
+    parser.add_argument('--num_blocks', type=int, default=1,
+                        help='Number of contiguous blocks each batch row is split into when shuffling.')
+    parser.add_argument('--bpe_merges', type=int, default=0,
+                        help='Number of byte-pair merges learned from the corpus, to train on sub-word '
+                             'tokens instead of characters. 0 trains on characters.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of the per-epoch block shuffling. Random if not given.')
+    parser.add_argument('--prefetch_depth', type=int, default=2,
+                        help='Number of batches prepared ahead on a background thread. 0 disables prefetching.')
+    parser.add_argument('--pipeline', type=str, default='feed', choices=['feed', 'dataset'],
+                        help='Feed batches through feed_dict or read them from a tf.data pipeline.')
+    parser.add_argument('--steps_per_run', type=int, default=1,
+                        help='Number of training steps run inside the graph per session call. '
+                             'More than 1 requires --pipeline=dataset & --stateful.')
+    parser.add_argument('--stateful', action='store_true',
+                        help='Keep the recurrent state in graph variables rather than feeding it every step.')
     parser.add_argument('--save_dir', type=str, default='saved',
                         help='Directory where checkpoints are stored.')
     parser.add_argument('--logdir', type=str, default='logs',
                         help='Tensorboard log directory.')
+    parser.add_argument('--scalar_every', type=int, default=1,
+                        help='Steps between scalar summaries (loss). 0 disables them.')
+    parser.add_argument('--histogram_every', type=int, default=100,
+                        help='Steps between histogram summaries (logits, sequence loss). 0 disables them.')
+    parser.add_argument('--trace_every', type=int, default=0,
+                        help='Steps between full traces, written as Chrome timelines & Tensorboard run '
+                             'metadata to the log directory. 0 disables tracing.')
     parser.add_argument('--rnn_size', type=int, default=128,
                         help='Size of RNN hidden cell state.')
     parser.add_argument('--num_layers', type=int, default=2,
                         help='Number of hidden layers in the network.')
     parser.add_argument('--model', type=str, default='lstm',
                         help='Recurrent architecture: RNN, LSTM, GRU or NAS')
+    parser.add_argument('--backend', type=str, default='static', choices=['static', 'dynamic', 'fused'],
+                        help='Recurrence over the sequence: statically unrolled, dynamic_rnn loop, '
+                             'or fused block kernels (LSTM & GRU only). Checkpoints are interchangeable.')
+    parser.add_argument('--softmax', type=str, default='full', choices=['full', 'sampled'],
+                        help='Training loss over the full vocab, or sampled softmax for large vocabs. '
+                             'Evaluation & sampling always use the full softmax.')
+    parser.add_argument('--num_sampled', type=int, default=64,
+                        help='Number of classes sampled per position with --softmax=sampled.')
     parser.add_argument('--batch_size', type=int, default=50,
                         help='Mini batch size.')
     parser.add_argument('--seq_length', type=int, default=50,
                         help='Recurrent sequence length.')
     parser.add_argument('--num_epochs', type=int, default=10,
                         help='Number of training epochs.')
+    parser.add_argument('--max_to_keep', type=int, default=5,
+                        help='Number of most recent checkpoints kept in save_dir.')
     parser.add_argument('--save_every', type=int, default=500,
                         help='Save frequency.')
     parser.add_argument('--grad_clip', type=float, default=5.,
@@ -73,7 +119,12 @@ def main():
 
 def train(args):
     # Load dataset.
-    data_loader = TextLoader(args.data_dir, args.batch_size, args.seq_length)
+    data_loader = TextLoader(args.data_dir, args.batch_size, args.seq_length,
+                             chunk_size=args.chunk_size, input_pattern=args.input_pattern,
+                             num_workers=args.num_workers, shuffle=args.shuffle,
+                             num_blocks=args.num_blocks, bpe_merges=args.bpe_merges)
+    if args.prefetch_depth > 0:
+        data_loader = BatchPrefetcher(data_loader, depth=args.prefetch_depth)
     args.vocab_size = data_loader.vocab_size
 
     # Checkpoint state.
@@ -125,81 +176,189 @@ def train(args):
     with open(os.path.join(args.save_dir, "chars_vocab.pkl"), mode="wb") as f:
         pickle.dump((data_loader.chars, data_loader.vocab), f)
 
-    # Define the model.
-    model = Model(args, training=True)
+    # Save the sub-word tokenizer's characters, merges & token order, if any.
+    tokenizer = data_loader.tokenizer
+    with open(os.path.join(args.save_dir, "bpe.pkl"), mode="wb") as f:
+        pickle.dump(None if tokenizer is None else (tokenizer.chars, tokenizer.merges, tokenizer.order), f)
 
-    # Start TensorFlow session. (with the default graph).
-    with tf.Session() as sess:
-        # Summary for Tensorboard.
-        summaries = tf.summary.merge_all()
-        writer = tf.summary.FileWriter(os.path.join(args.logdir, time.strftime("%Y-%m-%d-%H-%M-%S-%p")),
-                                       graph=sess.graph)
-        writer.add_graph(graph=sess.graph)
+    # Several steps per session call pull their own batches & keep the state in the graph.
+    assert args.steps_per_run == 1 or (args.pipeline == 'dataset' and args.stateful), \
+        "--steps_per_run > 1 requires --pipeline=dataset & --stateful"
 
-        # Initialize global variables.
-        sess.run(tf.global_variables_initializer())
+    # Define the model & its input pipeline.
+    iterator = train_loop = None
+    if args.pipeline == 'dataset':
+        iterator = make_iterator(data_loader, prefetch=max(args.prefetch_depth, 1))
+        model = Model(args, training=True, inputs=iterator.get_next(), stateful=args.stateful)
+        if args.steps_per_run > 1:
+            train_loop = model.build_train_loop(iterator)
+    else:
+        model = Model(args, training=True, stateful=args.stateful)
 
-        # Saver object for all global variables.
-        saver = tf.train.Saver(var_list=tf.global_variables())
+    # Position in the training data, saved along with the model in every checkpoint.
+    resume = build_resume(model)
 
-        # Restore model from checkpoint.
+    # Start TensorFlow session. (with the default graph).
+    with tf.Session() as sess:
+        # Summary for Tensorboard, fetched at the scalar & histogram cadences and written in the
+        # background. The training loop only summarizes its mean loss.
+        logdir = os.path.join(args.logdir, time.strftime("%Y-%m-%d-%H-%M-%S-%p"))
+        writer = tf.summary.FileWriter(logdir, graph=sess.graph)
+        writer.add_graph(graph=sess.graph)
+        tracer = StepTracer(logdir, every=args.trace_every, writer=writer)
+        if train_loop is not None:
+            telemetry = Telemetry(writer, scalars=train_loop['summary'], scalar_every=args.scalar_every)
+        else:
+            telemetry = Telemetry(writer, scalars=model.scalar_summaries, histograms=model.histogram_summaries,
+                                  scalar_every=args.scalar_every, histogram_every=args.histogram_every)
+
+        # Initialize global & local (recurrent state) variables.
+        sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+
+        # Saver object for the model's variables & checkpoints (training position included)
+        # written in the background.
+        resume_vars = [resume['epoch'], resume['batch'], resume['seed']] + resume['state']
+        model_vars = [var for var in tf.global_variables() if all(var is not r for r in resume_vars)]
+        saver = tf.train.Saver(var_list=model_vars)
+        checkpointer = AsyncCheckpointer(var_list=tf.global_variables(), max_to_keep=args.max_to_keep)
+
+        # Restore model from checkpoint & the position training stopped at, if saved.
+        start_epoch, start_batch, start_seed = 0, 0, -1
         if args.init_from is not None:
             saver.restore(sess=sess, save_path=ckpt.model_checkpoint_path)
-
-        # TRAINING LOOP.
-        for epoch in range(args.num_epochs):
+            try:
+                tf.train.Saver(var_list=resume_vars).restore(sess=sess, save_path=ckpt.model_checkpoint_path)
+                start_epoch, start_batch, start_seed = sess.run([resume['epoch'], resume['batch'],
+                                                                 resume['seed']])
+            except (tf.errors.NotFoundError, tf.errors.InvalidArgumentError):
+                print("No training position in checkpoint, starting from the first epoch.")
+
+            # Saved after the last batch of an epoch.
+            if start_batch >= data_loader.num_batches:
+                start_epoch, start_batch, start_seed = start_epoch + 1, 0, -1
+
+        def save_checkpoint(epoch: int, batch: int, state=None):
+            """Record the position of the next batch (& its initial state) and save a checkpoint."""
+            feeds = resume['feeds']
+            feed_dict = {feeds['epoch']: epoch, feeds['batch']: batch,
+                         feeds['seed']: -1 if data_loader.seed is None else data_loader.seed}
+            if 'state' in feeds:
+                feed_dict.update(zip(feeds['state'], nest.flatten(state)))
+            sess.run(resume['update'], feed_dict=feed_dict)
+
+            save_path = os.path.join(args.save_dir, "model.ckpt")
+            checkpointer.save(save_path=save_path, global_step=model.global_step, sess=sess)
+            return save_path
+
+        # TRAINING LOOP. Ctrl+C only stops training once the current step is recorded.
+        state = None if args.stateful else sess.run(model.initial_state)
+        interrupt = DeferredInterrupt()
+        for epoch in range(start_epoch, args.num_epochs):
             # NOTE: Surrounded with try-except in case training was force-stopped.
+            batch = 0
             try:
                 # Update Model's learning rate.
                 sess.run(tf.assign(model.lr, value=args.learning_rate * (args.decay_rate ** epoch)))
 
-                # Reset mini batch pointer.
-                data_loader.reset_batch_pointer()
-
-                # Initial state.
-                state = sess.run(model.initial_state)
-
-                for batch in range(data_loader.num_batches):
+                # Reset mini batch pointer, or resume the interrupted epoch at its next batch
+                # with the same block permutation.
+                seed = None if args.seed is None else args.seed + epoch
+                if epoch == start_epoch and start_batch > 0:
+                    batch, seed = start_batch, None if start_seed < 0 else start_seed
+                data_loader.reset_batch_pointer(seed=seed, pointer=batch)
+                if iterator is not None:
+                    sess.run(iterator.initializer)
+
+                # Recurrent state carried over to the resumed batch.
+                if not data_loader.is_block_start(batch):
+                    if args.stateful:
+                        sess.run(resume['restore_state'])
+                    else:
+                        state = sess.run(resume['state'])
+
+                while batch < data_loader.num_batches:
                     # Record start time for current batch.
                     start = time.time()
 
-                    # Get the next mini batch.
-                    X, y = data_loader.next_batch()
-
-                    feed_dict = {model.input_data: X, model.targets: y}
-
-                    for i, (c, h) in enumerate(model.initial_state):
-                        feed_dict[c] = state[i].c
-                        feed_dict[h] = state[i].h
-
-                    # Train the model.
-                    _, _loss, _global, _summary, state = sess.run([model.train_op, model.loss, model.global_step,
-                                                                   summaries, model.final_state], feed_dict=feed_dict)
-
-                    writer.add_summary(summary=_summary, global_step=_global)
+                    # Initial state, at the start of the epoch & of every shuffled block.
+                    if data_loader.is_block_start(batch):
+                        if args.stateful:
+                            sess.run(model.reset_state)
+                        else:
+                            state = sess.run(model.initial_state)
+
+                    # Get the next mini batch, unless read by the input pipeline.
+                    feed_dict = {}
+                    if iterator is None:
+                        X, y = data_loader.next_batch()
+                        feed_dict = {model.input_data: X, model.targets: y}
+
+                    # Train the model. The recurrent state is either kept in the graph or
+                    # fetched & fed back in, whatever its structure for the cell type.
+                    # The training loop runs several steps, up to the end of the current block.
+                    # Summaries due at any of the steps are fetched along.
+                    batch_count = epoch * data_loader.num_batches + batch
+                    steps = 1
+                    if train_loop is not None:
+                        steps = min(args.steps_per_run,
+                                    data_loader.batches_per_block - batch % data_loader.batches_per_block)
+                    fetches = telemetry.fetches(batch_count, steps=steps)
+                    options, run_metadata = tracer.options(batch_count, steps=steps)
+
+                    run_start = time.time()
+                    if train_loop is not None:
+                        _loss, _global, _summaries = sess.run([train_loop['loss'], train_loop['global_step'],
+                                                               fetches],
+                                                              feed_dict={train_loop['steps']: steps},
+                                                              options=options, run_metadata=run_metadata)
+                    elif args.stateful:
+                        _, _loss, _global, _summaries = sess.run([model.train_op, model.loss, model.global_step,
+                                                                  fetches], feed_dict=feed_dict,
+                                                                 options=options, run_metadata=run_metadata)
+                    else:
+                        feed_dict.update(zip(nest.flatten(model.initial_state), nest.flatten(state)))
+                        _, _loss, _global, _summaries, state = sess.run([model.train_op, model.loss,
+                                                                         model.global_step, fetches,
+                                                                         model.final_state],
+                                                                        feed_dict=feed_dict, options=options,
+                                                                        run_metadata=run_metadata)
 
                     end = time.time()
-                    batch_count = epoch * data_loader.num_batches + batch
+                    telemetry.record(_summaries, global_step=_global, duration=end - run_start, steps=steps)
+                    tracer.record(run_metadata, step=_global)
 
                     # Log progress.
                     print("\r{:,} of {:,} | global: {:,} Loss: {} time/batch: {}"
-                          .format(batch_count, args.num_epochs, _global, _loss, end - start), end="")
+                          .format(batch_count, args.num_epochs, _global, _loss, (end - start) / steps), end="")
+
+                    # Save model at intervals, i.e. when one of the batches just trained on is due.
+                    batch += steps
+                    if -batch_count % args.save_every < steps or (
+                                    epoch == args.num_epochs - 1 and batch == data_loader.num_batches):
+                        save_path = save_checkpoint(epoch, batch, state)
 
-                    # Save model at intervals.
-                    if batch_count % args.save_every == 0 or (
-                                    epoch == args.num_epochs - 1 and batch == data_loader.num_batches - 1):
-                        save_path = os.path.join(args.save_dir, "model.ckpt")
-                        saver.save(sess=sess, save_path=save_path, global_step=model.global_step)
+                        print("\nSaving model to {}\n".format(save_path))
 
-                        print("\nModel saved to {}\n".format(save_path))
+                    # Stop on Ctrl+C, the batch & state now matching the trained weights.
+                    if interrupt.requested:
+                        raise KeyboardInterrupt
 
                 """# !- end batch"""
+
+                # Time the training loop spent stalled, waiting on data.
+                if isinstance(data_loader, BatchPrefetcher):
+                    print("\nEpoch {:,} waited {:.3f}s on data ({:.3f}s total)"
+                          .format(epoch, data_loader.epoch_wait_time, data_loader.wait_time))
             except KeyboardInterrupt:
+                # Forced mid-step: the trained weights are ahead of the recorded position.
+                if interrupt.forced:
+                    print('\nTraining aborted by user, keeping the last checkpoint.')
+                    break
+
                 print('\nTraining interrupted by user. Saving...')
 
-                save_path = os.path.join(args.save_dir, "model.ckpt")
-                saver.save(sess=sess, save_path=save_path,
-                           global_step=model.global_step)
+                save_path = save_checkpoint(epoch, batch, state)
+                checkpointer.flush()
 
                 print("Model saved to {}\n".format(save_path))
 
@@ -207,8 +366,95 @@ def train(args):
                 break
 
         # !- end epoch
+        interrupt.restore()
         print("\n\nOverall training count = {}".format(sess.run(model.global_step)))
 
+        # Wait for the last checkpoint & summaries to be written.
+        checkpointer.close()
+        print("Checkpoints: training stalled {:.3f}s, written in the background in {:.3f}s"
+              .format(checkpointer.stall_time, checkpointer.write_time))
+
+        telemetry.close()
+        stats = telemetry.stats()
+        print("Telemetry: {:,} of {:,} steps instrumented, overhead {:.3f}s ({:.1%} of step time), "
+              "written in the background in {:.3f}s".format(stats['instrumented_steps'], stats['steps'],
+                                                            stats['overhead'], stats['overhead_ratio'],
+                                                            stats['write_time']))
+        if stats['baseline']:
+            print("Telemetry: no step ran without summaries, overhead is relative to steps fetching {} "
+                  "& excludes their cost".format(' & '.join(stats['baseline'])))
+
+        if args.trace_every > 0:
+            print(tracer.summary())
+
+        if isinstance(data_loader, BatchPrefetcher):
+            data_loader.close()
+
+
+class DeferredInterrupt:
+    """Defer Ctrl+C (SIGINT) until the training loop checks `requested`.
+
+    An interrupt raised during `sess.run` would only surface once the step has been
+    applied, before its batch & state are recorded. The first Ctrl+C is recorded
+    instead, a second one interrupts right away & sets `forced`.
+    """
+
+    def __init__(self):
+        self.requested = False
+        self.forced = False
+        self._handler = signal.signal(signal.SIGINT, self._interrupt)
+
+    def _interrupt(self, signum, frame):
+        if self.requested:
+            self.forced = True
+            raise KeyboardInterrupt
+        self.requested = True
+
+    def restore(self):
+        """Restore the previous SIGINT handler."""
+        signal.signal(signal.SIGINT, self._handler)
+
+
+def build_resume(model: Model):
+    """Variables recording the position of training, to resume an interrupted epoch exactly.
+
+    Must be built before the checkpointer, for the checkpoints to include them.
+
+    Arguments:
+        model {Model} -- Model being trained.
+
+    Returns:
+        {dict} -- epoch, batch (next batch of the epoch) & seed (of the block permutation, -1 if
+            none) int64 variables, state variables (initial recurrent state of the next batch),
+            `update` op assigning them from `feeds` (& from the model's state variables when
+            stateful), `restore_state` op assigning the saved state to the model's state variables.
+    """
+    flat_state = nest.flatten(model.initial_state)
+
+    with tf.variable_scope('resume'):
+        names = ['epoch', 'batch', 'seed']
+        resume = {name: tf.Variable(0, dtype=tf.int64, trainable=False, name=name) for name in names}
+        resume['state'] = [tf.Variable(tf.zeros(state.shape, dtype=state.dtype), trainable=False,
+                                       name='state_{}'.format(i)) for i, state in enumerate(flat_state)]
+
+        feeds = {name: tf.placeholder(tf.int64, shape=[], name=name) for name in names}
+
+        # The state is read from the graph when stateful, fed otherwise.
+        if model.state_variables:
+            state = [var.read_value() for var in model.state_variables]
+        else:
+            state = feeds['state'] = [tf.placeholder(s.dtype, shape=s.shape) for s in flat_state]
+
+        updates = [tf.assign(resume[name], feeds[name]) for name in names]
+        updates += [tf.assign(var, value) for var, value in zip(resume['state'], state)]
+        resume['update'] = tf.group(*updates, name='update')
+        resume['feeds'] = feeds
+
+        resume['restore_state'] = tf.group(*[tf.assign(var, saved) for var, saved in
+                                             zip(model.state_variables, resume['state'])], name='restore_state')
+
+    return resume
+
 
 if __name__ == '__main__':
     main()
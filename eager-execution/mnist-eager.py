@@ -15,10 +15,17 @@
      Copyright (c) 2018. Victor I. Afolabi. All rights reserved.
 
 """
+import os
+import sys
+
 import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.eager.python import tfe
 
+# Checkpointer of char_rnn, imported from its directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'char_rnn'))
+from checkpoint import AsyncCheckpointer
+
 # Turn on Eager execution mode.
 tf.enable_eager_execution()
 
@@ -162,7 +169,9 @@ def main():
     model = Model()
     optimizer = tf.train.AdamOptimizer(learning_rate=learning_rate)
     global_step = tf.train.get_or_create_global_step()
-    saver = tfe.Checkpoint(model=model, optimizer=optimizer, global_step=global_step)
+
+    # Checkpoints written in the background. Created once the optimizer's slots exist.
+    checkpointer = None
 
     print('{0}\n\t\tTRAINING STARTED!\n{0}\n'.format(55 * '-'))
 
@@ -181,16 +190,27 @@ def main():
                        '\tLoss: {:.3f}').format(epoch + 1, global_step.numpy(), batch + 1, loss.numpy()),
                       end='')
 
+                if checkpointer is None:
+                    checkpointer = AsyncCheckpointer(var_list=model.variables + optimizer.variables() + [global_step])
+
                 if global_step.numpy() % save_step == 0:
                     print('\nSaving model to {}'.format(save_path))
-                    saver.save(save_path)
+                    checkpointer.save(save_path, global_step=global_step)
 
         except KeyboardInterrupt:
             print('\n{}\nTraining interrupted by user'.format(55 * ''))
-            saver.save(file_prefix=save_path)
-            print('Model saved to {}'.format(save_path))
+            if checkpointer is not None:
+                checkpointer.save(save_path, global_step=global_step)
+                checkpointer.flush()
+                print('Model saved to {}'.format(save_path))
+            else:
+                print('Nothing trained yet, no model saved.')
             break
 
+    # Wait for the last checkpoint to be written.
+    if checkpointer is not None:
+        checkpointer.close()
+
     # !- End epochs.
     print('\n\n{0}\n\t\tTRAINING ENDED!\n{0}\n'.format(55 * '-'))
 
@@ -16,12 +16,17 @@
 """
 
 import os
+import sys
 import argparse
 
 import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.data import batch_and_drop_remainder
 
+# Checkpointer of char_rnn, imported from its directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'char_rnn'))
+from checkpoint import AsyncCheckpointer
+
 # Command line arguments.
 args = None
 
@@ -152,6 +157,7 @@ def main():
         save_path = os.path.join(args.save_dir, 'model.ckpt')
 
         saver = tf.train.Saver()
+        checkpointer = AsyncCheckpointer()
         writer = tf.summary.FileWriter(logdir=args.logdir, graph=sess.graph)
 
         # Restore Training session properly.
@@ -185,8 +191,7 @@ def main():
                         if _step % args.save_every == 0:
                             print('\n{}'.format('-' * 65))
                             print('Saving model to {}'.format(save_path))
-                            saver.save(sess=sess, save_path=save_path,
-                                       global_step=global_step)
+                            checkpointer.save(save_path=save_path, global_step=global_step, sess=sess)
                             print('{}\n'.format('-' * 65))
 
                         print('\rEpoch: {:,}\tStep: {:,}\tAcc: {:.2%}\tLoss: {:.3f}'
@@ -199,12 +204,15 @@ def main():
                 print('\nTraining interrupted by user!')
                 print('\n{}'.format('-' * 65))
                 print('Saving model to {}'.format(save_path))
-                saver.save(sess=sess, save_path=save_path,
-                           global_step=global_step)
+                checkpointer.save(save_path=save_path, global_step=global_step, sess=sess)
+                checkpointer.flush()
                 print('{}\n'.format('-' * 65))
                 # End training.
                 break
 
+        # Wait for the last checkpoint to be written.
+        checkpointer.close()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
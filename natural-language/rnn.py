@@ -17,11 +17,17 @@
 
 import argparse
 import os.path
+import sys
 
 import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.data import batch_and_drop_remainder
 
+# Checkpointer (& tracer) of char_rnn, imported from its directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'char_rnn'))
+from checkpoint import AsyncCheckpointer
+from tracing import StepTracer
+
 # Command line arguments.
 args = None
 
@@ -252,7 +258,9 @@ def main():
 
         # Saver & Summary writer.
         saver = tf.train.Saver()
+        checkpointer = AsyncCheckpointer()
         writer = tf.summary.FileWriter(logdir=args.logdir, graph=sess.graph)
+        tracer = StepTracer(args.logdir, every=args.trace_every, writer=writer)
 
         init = tf.global_variables_initializer()
 
@@ -271,15 +279,19 @@ def main():
             sess.run(init)
 
         # Each training epochs.
+        _step = sess.run(global_step)
         for epoch in range(args.epochs):
             try:
                 # Reset iterator initializer.
                 sess.run(train_iter)
                 while True:
                     try:
-                        # Train the network.
+                        # Train the network, tracing the step if it's due.
+                        options, run_metadata = tracer.options(_step)
                         _, _step, _loss, _acc = sess.run([train_op, global_step,
-                                                          loss, accuracy])
+                                                          loss, accuracy],
+                                                         options=options, run_metadata=run_metadata)
+                        tracer.record(run_metadata, step=_step)
                         # Log training progress.
                         print('\rEpoch: {:,} Step: {:,} Acc: {:.2%} Loss: {:.3f}'
                               .format(epoch + 1, _step, _acc, _loss), end='')
@@ -293,8 +305,7 @@ def main():
                         if _step % args.save_every == 0:
                             print('\n{}\nSaving model to {}'
                                   .format('-' * 65, save_path))
-                            saver.save(sess=sess, save_path=save_path,
-                                       global_step=global_step)
+                            checkpointer.save(save_path=save_path, global_step=global_step, sess=sess)
                             print('{}\n'.format('-' * 65))
 
                     except tf.errors.OutOfRangeError:
@@ -303,14 +314,20 @@ def main():
                 print('\n{}\nTraining interrupted by user!'.format('-' * 65))
 
                 print('Saving model to {}'.format(save_path))
-                saver.save(sess=sess, save_path=save_path,
-                           global_step=global_step)
+                checkpointer.save(save_path=save_path, global_step=global_step, sess=sess)
+                checkpointer.flush()
 
                 print('{}\n'.format('-' * 65))
 
                 # End training.
                 break
 
+        # Wait for the last checkpoint to be written.
+        checkpointer.close()
+
+        if args.trace_every > 0:
+            print('\n{}'.format(tracer.summary()))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -352,6 +369,9 @@ if __name__ == '__main__':
                         help='Tensorboard log directory.')
     parser.add_argument('--log_every', type=int, default=200,
                         help='Log for tensorboard every number of steps.')
+    parser.add_argument('--trace_every', type=int, default=0,
+                        help='Fully trace a step every number of steps, writing Chrome '
+                             'timelines & run metadata to the log directory. 0 disables tracing.')
 
     args = parser.parse_args()
 
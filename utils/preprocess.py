@@ -1,144 +1,1019 @@
+import io
 import os
-import codecs
+import glob
+import json
+import mmap
+import struct
+import hashlib
 import collections
-import pickle
+import functools
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
 
 import numpy as np
 
+# Number of bytes hashed at the head & tail of a file when fingerprinting it.
+FINGERPRINT_BLOCK = 1 << 16
+
+# Corpus file layout: magic bytes & offset of the token body, followed by a JSON header.
+CORPUS_MAGIC = b'CHARRNN\x01'
+CORPUS_PREFIX = struct.Struct('<8sQ')
+
+# Spare bytes left after the JSON header, so it can grow when text is appended.
+CORPUS_SLACK = 1 << 12
+
+# Largest number of possible id pairs counted with a dense histogram while learning merges.
+BPE_DENSE_PAIRS = 1 << 24
+
+
+def token_dtype(vocab_size: int):
+    """Smallest unsigned integer type which can hold every vocab id.
+
+    Arguments:
+        vocab_size {int} -- Number of unique tokens in the vocab.
+
+    Returns:
+        {np.dtype} -- One of uint8, uint16 or uint32.
+    """
+    for dtype in (np.uint8, np.uint16):
+        if vocab_size <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    return np.dtype(np.uint32)
+
+
+def read_chunks(input_file: str, encoding: str = 'utf-8', chunk_size: int = None, offset: int = 0):
+    """Read a text file `chunk_size` characters at a time.
+
+    Arguments:
+        input_file {str} -- Input file containing the text data.
+
+    Keyword Arguments:
+        encoding {str} -- Text encoding of `input_file`. (default: {'utf-8'})
+        chunk_size {int} -- Maximum number of characters per chunk. (default: {None} -- whole file)
+        offset {int} -- Byte offset to start reading from. (default: {0})
+
+    Yields:
+        {str} -- Next chunk of text.
+    """
+    with io.open(input_file, mode='rb') as raw:
+        raw.seek(offset)
+
+        # newline='' leaves line endings untouched, same as `codecs.open`.
+        f = io.TextIOWrapper(raw, encoding=encoding, newline='')
+        chunk = f.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = f.read(chunk_size)
+
+
+def encode_chars(data: str, chars: tuple, dtype: np.dtype):
+    """Convert text into the vocab id of each character.
+
+    Characters are mapped as whole arrays of UTF-32 code points through a
+    lookup table indexed by code point, instead of one dict lookup per character.
+
+    Arguments:
+        data {str} -- Text to be encoded.
+        chars {tuple} -- Vocab characters, ordered by id.
+        dtype {np.dtype} -- Data type of the returned ids.
+
+    Raises:
+        KeyError -- Characters missing from the vocab.
+
+    Returns:
+        {np.ndarray} -- Vocab id of each character in `data`.
+    """
+    # Code point of every character in the text.
+    codes = np.frombuffer(data.encode('utf-32-le'), dtype=np.uint32)
+
+    # Lookup table from code point to vocab id, -1 for code points missing from the vocab.
+    table = np.full(shape=max(map(ord, chars)) + 1, fill_value=-1, dtype=np.int64)
+    table[[ord(c) for c in chars]] = np.arange(len(chars))
+
+    ids = table[np.minimum(codes, table.size - 1)]
+    unknown = (codes >= table.size) | (ids < 0)
+    if unknown.any():
+        raise KeyError("Characters not in vocab: {!r}".format(sorted(set(map(chr, codes[unknown])))))
+
+    return ids.astype(dtype)
+
+
+def count_chars(input_file: str, encoding: str = 'utf-8', chunk_size: int = None, offset: int = 0):
+    """Count every character of a text file.
+
+    Arguments:
+        input_file {str} -- Input file containing the text data.
+
+    Keyword Arguments:
+        encoding {str} -- Text encoding of `input_file`. (default: {'utf-8'})
+        chunk_size {int} -- Number of characters read at a time. (default: {None} -- whole file)
+        offset {int} -- Byte offset to start counting from. (default: {0})
+
+    Returns:
+        {collections.Counter} -- Character counts, in order of first occurrence.
+    """
+    counter = collections.Counter()
+    for chunk in read_chunks(input_file, encoding=encoding, chunk_size=chunk_size, offset=offset):
+        counter.update(chunk)
+    return counter
+
+
+def write_corpus_header(corpus_file: str, header: dict, body_offset: int = None):
+    """Write the header of a corpus file.
+
+    A corpus file is a single self-describing container: the magic bytes, the offset
+    of the token body as a little-endian uint64, a JSON header (vocab, dtype, size &
+    fingerprints) padded with spaces & finally the contiguous token body, which
+    starts on a page boundary so it can be memory mapped as is.
+
+    Arguments:
+        corpus_file {str} -- Corpus file, created if it doesn't exist.
+        header {dict} -- Header to be written.
+
+    Keyword Arguments:
+        body_offset {int} -- Offset of the token body in an existing file. (default: {None} --
+            choose one leaving some slack for the header to grow)
+
+    Raises:
+        ValueError -- Header doesn't fit before `body_offset`.
+
+    Returns:
+        {int} -- Offset of the token body.
+    """
+    data = json.dumps(header).encode('utf-8')
+    if body_offset is None:
+        body_offset = -(-(CORPUS_PREFIX.size + len(data) + CORPUS_SLACK) // mmap.PAGESIZE) * mmap.PAGESIZE
+
+    if CORPUS_PREFIX.size + len(data) > body_offset:
+        raise ValueError("Corpus header doesn't fit in {:,} bytes.".format(body_offset))
+
+    with open(corpus_file, mode='r+b' if os.path.exists(corpus_file) else 'w+b') as f:
+        f.write(CORPUS_PREFIX.pack(CORPUS_MAGIC, body_offset))
+        f.write(data.ljust(body_offset - CORPUS_PREFIX.size))
+
+        # Allocate the token body.
+        size = header['size'] * np.dtype(header['dtype']).itemsize
+        if os.fstat(f.fileno()).st_size < body_offset + size:
+            f.truncate(body_offset + size)
+
+    return body_offset
+
+
+def read_corpus_header(corpus_file: str):
+    """Read the header of a corpus file.
+
+    Arguments:
+        corpus_file {str} -- Corpus file written by `write_corpus_header`.
+
+    Raises:
+        ValueError -- Not a corpus file.
+
+    Returns:
+        {tuple} -- Header {dict} & offset of the token body {int}.
+    """
+    with open(corpus_file, mode='rb') as f:
+        magic, body_offset = CORPUS_PREFIX.unpack(f.read(CORPUS_PREFIX.size))
+        if magic != CORPUS_MAGIC:
+            raise ValueError("{} is not a corpus file.".format(corpus_file))
+
+        header = json.loads(f.read(body_offset - CORPUS_PREFIX.size).decode('utf-8'))
+
+    return header, body_offset
+
+
+def encode_file(input_file: str, corpus_file: str, offset: int, chars: tuple,
+                encoding: str = 'utf-8', chunk_size: int = None):
+    """Encode a text file into a region of an allocated corpus file.
+
+    Arguments:
+        input_file {str} -- Input file containing the text data.
+        corpus_file {str} -- Corpus file the ids are written into.
+        offset {int} -- Position in the token body of the first character of `input_file`.
+        chars {tuple} -- Vocab characters, ordered by id.
+
+    Keyword Arguments:
+        encoding {str} -- Text encoding of `input_file`. (default: {'utf-8'})
+        chunk_size {int} -- Number of characters read at a time. (default: {None} -- whole file)
+
+    Returns:
+        {int} -- Number of characters written.
+    """
+    header, body_offset = read_corpus_header(corpus_file)
+    tensor = np.memmap(corpus_file, dtype=header['dtype'], mode='r+',
+                       offset=body_offset, shape=(header['size'],))
+
+    start = offset
+    for chunk in read_chunks(input_file, encoding=encoding, chunk_size=chunk_size):
+        tensor[offset:offset + len(chunk)] = encode_chars(chunk, chars, dtype=tensor.dtype)
+        offset += len(chunk)
+
+    tensor.flush()
+    return offset - start
+
+
+def append_corpus(corpus_file: str, chunks, **header):
+    """Append ids to the token body of a corpus file.
+
+    The ids are written past the current end of the body before the header is
+    updated, so an interrupted append leaves the previous corpus intact. The header
+    is rewritten in place when it fits its padding, otherwise the whole file is rewritten.
+
+    Arguments:
+        corpus_file {str} -- Corpus file to be extended.
+        chunks {iterable} -- Arrays of ids to append, in order.
+
+    Keyword Arguments:
+        **header -- Other header fields to be updated, e.g. fingerprints.
+
+    Returns:
+        {int} -- Number of ids appended.
+    """
+    old_header, body_offset = read_corpus_header(corpus_file)
+    dtype = np.dtype(old_header['dtype'])
+
+    # Write the new ids after the existing ones.
+    size = old_header['size']
+    with open(corpus_file, mode='r+b') as f:
+        f.seek(body_offset + size * dtype.itemsize)
+        for chunk in chunks:
+            f.write(np.asarray(chunk, dtype=dtype).tobytes())
+            size += len(chunk)
+        f.truncate()
+
+    new_header = dict(old_header, size=size, **header)
+    try:
+        write_corpus_header(corpus_file, new_header, body_offset=body_offset)
+    except ValueError:
+        # Header outgrew its padding: rewrite the whole file.
+        body = np.memmap(corpus_file, dtype=dtype, mode='r', offset=body_offset, shape=(size,))
+        new_offset = write_corpus_header(corpus_file + '.tmp', new_header)
+        tensor = np.memmap(corpus_file + '.tmp', dtype=dtype, mode='r+', offset=new_offset, shape=(size,))
+        tensor[:] = body
+        tensor.flush()
+        del body, tensor
+        os.replace(corpus_file + '.tmp', corpus_file)
+
+    return size - old_header['size']
+
+
+def file_fingerprint(input_file: str, size: int = None):
+    """Fingerprint of a file: its size, modification time & hashes of its head and tail.
+
+    Arguments:
+        input_file {str} -- File to be fingerprinted.
+
+    Keyword Arguments:
+        size {int} -- Only fingerprint the first `size` bytes, as if the file ended there.
+            The modification time isn't recorded in this case. (default: {None} -- whole file)
+
+    Returns:
+        {dict} -- Fingerprint with keys: size, mtime, head & tail.
+    """
+    mtime = None
+    if size is None:
+        stat = os.stat(input_file)
+        size, mtime = stat.st_size, stat.st_mtime
+
+    with open(input_file, mode='rb') as f:
+        head = hashlib.sha1(f.read(min(size, FINGERPRINT_BLOCK))).hexdigest()
+
+        f.seek(max(0, size - FINGERPRINT_BLOCK))
+        tail = hashlib.sha1(f.read(size - f.tell())).hexdigest()
+
+    return {'size': size, 'mtime': mtime, 'head': head, 'tail': tail}
+
+
+def merge_pair(ids: np.ndarray, left: int, right: int, new_id: int):
+    """Replace every occurrence of a pair of ids by a new id, left to right.
+
+    Arguments:
+        ids {np.ndarray} -- Token ids, of a type which can hold `new_id`.
+        left {int} -- First id of the pair.
+        right {int} -- Second id of the pair.
+        new_id {int} -- Id replacing the pair.
+
+    Returns:
+        {np.ndarray} -- Merged ids, or `ids` itself if the pair doesn't occur.
+    """
+    match = np.flatnonzero((ids[:-1] == left) & (ids[1:] == right))
+    if match.size == 0:
+        return ids
+
+    # Occurrences overlap in runs of the same id (e.g. 'aaa'): only every other one, from the run's start.
+    if left == right:
+        run_start = np.concatenate([[True], np.diff(match) > 1])
+        first = match[run_start][np.cumsum(run_start) - 1]
+        match = match[(match - first) % 2 == 0]
+
+    keep = np.ones(ids.size, dtype=bool)
+    keep[match + 1] = False
+    merged = ids[keep]
+
+    # Every earlier occurrence dropped one id before this one.
+    merged[match - np.arange(match.size)] = new_id
+    return merged
+
+
+class BytePairEncoder:
+    """Sub-word tokenizer merging the most frequent pairs of adjacent tokens.
+
+    Merges are learned over merge ids: the vocab characters, followed by one id per
+    merge, in the order they were learned. Encoding applies every merge in turn to
+    whole arrays of ids, so it costs one vectorized pass over the text per merge.
+    Token ids then renumber the merge ids by decreasing frequency in the corpus, like
+    character ids, which e.g. the log-uniform sampler of sampled softmax relies on.
+
+    Arguments:
+        chars {tuple} -- Vocab characters, ordered by id.
+
+    Keyword Arguments:
+        merges {list} -- (left id, right id) pairs merged into ids `len(chars)`, `len(chars) + 1`, ...
+            (default: {()})
+        order {list} -- Merge id of every token id, see `sort`. (default: {None} -- token ids are
+            the merge ids)
+    """
+
+    def __init__(self, chars: tuple, merges: list = (), order: list = None):
+        self.chars = tuple(chars)
+        self.merges = [tuple(merge) for merge in merges]
+
+        # Text of every merge id.
+        texts = list(self.chars)
+        for left, right in self.merges:
+            texts.append(texts[left] + texts[right])
+
+        # Token id of every merge id & text of every token.
+        self.order = list(range(len(texts))) if order is None else [int(i) for i in order]
+        self.rank = np.empty(len(texts), dtype=np.int64)
+        self.rank[self.order] = np.arange(len(texts))
+        self.tokens = tuple(texts[i] for i in self.order)
+
+    @property
+    def vocab_size(self):
+        """Number of tokens: characters & merges.
+
+        Returns:
+            {int} -- Size of the token vocab.
+        """
+        return len(self.tokens)
+
+    @classmethod
+    def learn(cls, ids: np.ndarray, chars: tuple, num_merges: int, sample_size: int = 1 << 22):
+        """Learn merges from character ids, most frequent pair first.
+
+        Arguments:
+            ids {np.ndarray} -- Vocab id of each character of the text.
+            chars {tuple} -- Vocab characters, ordered by id.
+            num_merges {int} -- Maximum number of merges. Learning stops early once no pair
+                occurs more than once.
+
+        Keyword Arguments:
+            sample_size {int} -- Number of characters, from the start of `ids`, merges are learned
+                from. (default: {4 Mi})
+
+        Returns:
+            {BytePairEncoder} -- Tokenizer with the learned merges.
+        """
+        ids = np.asarray(ids[:sample_size], dtype=np.int32)
+        base = len(chars) + num_merges
+        merges = []
+
+        for new_id in range(len(chars), base):
+            if ids.size < 2:
+                break
+
+            # Count every pair of adjacent ids at once, as `left * base + right`.
+            pairs = ids[:-1].astype(np.int64) * base + ids[1:]
+            if base * base <= BPE_DENSE_PAIRS:
+                counts = np.bincount(pairs)
+                best = int(np.argmax(counts))
+                count = counts[best]
+            else:
+                uniques, counts = np.unique(pairs, return_counts=True)
+                best = int(np.argmax(counts))
+                best, count = int(uniques[best]), counts[best]
+
+            if count < 2:
+                break
+
+            left, right = divmod(best, base)
+            ids = merge_pair(ids, left, right, new_id)
+            merges.append((left, right))
+
+        return cls(chars, merges)
+
+    def sort(self, counts: np.ndarray):
+        """Tokenizer with the same merges, numbering tokens by decreasing count.
+
+        Arguments:
+            counts {np.ndarray} -- Number of occurrences of every merge id in the corpus.
+
+        Returns:
+            {BytePairEncoder} -- Tokenizer whose token ids are sorted by decreasing count,
+                ties in merge id order.
+        """
+        return BytePairEncoder(self.chars, self.merges, order=np.argsort(-np.asarray(counts), kind='stable'))
+
+    def merge_ids(self, ids: np.ndarray):
+        """Apply every merge, in order, to character ids.
+
+        Arguments:
+            ids {np.ndarray} -- Vocab id of each character of the text.
+
+        Returns:
+            {np.ndarray} -- Merge ids, as int32.
+        """
+        ids = np.asarray(ids, dtype=np.int32)
+        for new_id, (left, right) in enumerate(self.merges, len(self.chars)):
+            ids = merge_pair(ids, left, right, new_id)
+        return ids
+
+    def encode_ids(self, ids: np.ndarray):
+        """Convert character ids into token ids.
+
+        Arguments:
+            ids {np.ndarray} -- Vocab id of each character of the text.
+
+        Returns:
+            {np.ndarray} -- Token ids, stored in the smallest type holding every token id.
+        """
+        return self.rank[self.merge_ids(ids)].astype(token_dtype(self.vocab_size))
+
+    def encode(self, data: str):
+        """Convert text into token ids.
+
+        Arguments:
+            data {str} -- Text to be encoded, made of vocab characters only.
+
+        Raises:
+            KeyError -- Characters missing from the vocab.
+
+        Returns:
+            {np.ndarray} -- Token ids.
+        """
+        return self.encode_ids(encode_chars(data, self.chars, dtype=np.int32))
+
+    def decode(self, ids):
+        """Convert token ids back into text.
+
+        Arguments:
+            ids {iterable} -- Token ids.
+
+        Returns:
+            {str} -- Decoded text.
+        """
+        return ''.join(self.tokens[i] for i in ids)
+
 
 class TextLoader:
     """Data loader for character or text dataset.
 
     Arguments:
-        data_dir {str} -- Directory containing input.txt
+        data_dir {str} -- Directory containing input.txt or text shards.
         batch_size {int} -- Mini batch size.
         seq_length {int} -- Sequence length.
 
     Keyword Arguments:
         encoding {str} -- Text encoding for reading and writing to files. (default: {'utf-8'})
+        chunk_size {int} -- Number of characters read at a time while pre-processing. When given,
+            text is streamed in chunks so memory is bounded by the chunk size rather than
+            the corpus size. (default: {None} -- read each file at once)
+        input_pattern {str} -- Glob, relative to `data_dir`, of the text files making up the
+            corpus. Files are concatenated in sorted order. (default: {'input.txt'})
+        num_workers {int} -- Number of processes used to count & encode text files.
+            (default: {None} -- one per CPU core)
+        shuffle {bool} -- Shuffle the order of blocks every time the batch pointer is reset.
+            (default: {False})
+        num_blocks {int} -- Number of contiguous blocks each row of a batch is split into.
+            Rows keep a continuous stream of text within a block. (default: {1})
+        bpe_merges {int} -- Number of byte-pair merges learned from the corpus. Batches then
+            hold sub-word tokens rather than characters. (default: {0} -- characters)
     """
 
-    def __init__(self, data_dir: str, batch_size: int, seq_length: int, encoding='utf-8'):
+    def __init__(self, data_dir: str, batch_size: int, seq_length: int, encoding='utf-8',
+                 chunk_size: int = None, input_pattern: str = 'input.txt', num_workers: int = None,
+                 shuffle: bool = False, num_blocks: int = 1, bpe_merges: int = 0):
         # Arguments and Keyword arguments.
         self.data_dir = data_dir
         self.batch_size = batch_size
         self.seq_length = seq_length
         self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.num_workers = num_workers or os.cpu_count()
+        self.shuffle = shuffle
+        self.num_blocks = num_blocks
 
         # Initialize instance variables to prevent warning.
         self.chars = []
         self.vocab = {}
         self.vocab_size = 0
+        self.tokenizer = None
         self.tensor = None
-        self.x_batch = None
-        self.y_batch = None
+        self.blocks = None
+        self.seed = None
         self.num_batches = 0
 
         # Data files.
-        input_file = os.path.join(data_dir, 'input.txt')
-        vocab_file = os.path.join(data_dir, 'vocab.pkl')
-        tensor_file = os.path.join(data_dir, 'data.npy')
+        input_files = sorted(glob.glob(os.path.join(data_dir, input_pattern)))
+        corpus_file = os.path.join(data_dir, 'corpus.bin')
 
-        if not (os.path.exists(vocab_file) and os.path.exists(tensor_file)):
-            # Pre process data.
-            print('Reading text file...')
-            self.preprocess(input_file, vocab_file, tensor_file)
-        else:
+        # Fingerprints of the input files & the ones the corpus was built from.
+        fingerprints = [[os.path.relpath(input_file, data_dir), file_fingerprint(input_file)]
+                        for input_file in input_files]
+        cached = None
+        if os.path.exists(corpus_file):
+            cached = read_corpus_header(corpus_file)[0]['fingerprints']
+
+        if cached is not None and (not input_files or cached == fingerprints):
             # Load pre-processed files.
             print('Loading pre-processed files...')
-            self.load_preprocessed(vocab_file=vocab_file, tensor_file=tensor_file)
+            self.load_preprocessed(corpus_file)
+        elif cached is not None and self.update_preprocessed(cached, fingerprints, input_files, corpus_file):
+            print('Encoded text appended to pre-processed files.')
+        else:
+            if not input_files:
+                raise FileNotFoundError("No text file matching {!r} in {}".format(input_pattern, data_dir))
+
+            # Pre process data.
+            print('Reading {:,} text file(s)...'.format(len(input_files)))
+            self.preprocess(input_files, corpus_file, fingerprints)
+
+        # Sub-word tokens.
+        if bpe_merges > 0:
+            self.tokenize(corpus_file, bpe_merges)
 
         # Create batches & set batch pointer to 0.
         self.create_batches()
-        self.pointer = 0
+        self.reset_batch_pointer()
 
-    def preprocess(self, input_file: str, vocab_file: str, tensor_file: str):
+    def preprocess(self, input_files: list, corpus_file: str, fingerprints: list = None):
         """Pre-process dataset. Converts text data into numeric format.
 
+        Files are counted in a first pass and encoded in a second one, each spread
+        over a pool of `self.num_workers` processes (one file per task).
+
         Arguments:
-            input_file {str} -- Input file containing the text data.
-            vocab_file {str} -- File where all unique characters/vocab in the dataset is stored.
-            tensor_file {str} -- File where the numeric representation of dataset is saved.
+            input_files {list} -- Input files containing the text data.
+            corpus_file {str} -- File where the vocab & numeric representation of dataset is saved.
+
+        Keyword Arguments:
+            fingerprints {list} -- (path, fingerprint) of each input file, recorded in the
+                corpus file header. (default: {None})
         """
+        pool = None
+        if self.num_workers > 1 and len(input_files) > 1:
+            pool = multiprocessing.Pool(processes=min(self.num_workers, len(input_files)))
+        starmap = pool.starmap if pool is not None else lambda fn, it: list(itertools.starmap(fn, it))
+
+        try:
+            # First pass: count characters of every file. Merging in file order
+            # keeps ties in order of first occurrence, as if counted in one go.
+            counts = starmap(functools.partial(count_chars, encoding=self.encoding,
+                                               chunk_size=self.chunk_size),
+                             [(input_file,) for input_file in input_files])
+            counter = collections.Counter()
+            for count in counts:
+                counter.update(count)
+
+            # List of tuples: [(' ', 14), ('e', 18), ..., ('m', 1)]
+            count_pairs = sorted(counter.items(), key=lambda x: -x[1])
+
+            # Extract the characters: returns tuple of chars.
+            self.chars, _ = zip(*count_pairs)
+
+            # Number of characters in the dataset.
+            self.vocab_size = len(self.chars)
+
+            # Mapping from char to id or vocab.
+            self.vocab = {c: i for i, c in enumerate(self.chars)}
+
+            # Numeric representation of dataset, allocated up front so every
+            # file is encoded straight into its own region of the token body.
+            sizes = [sum(count.values()) for count in counts]
+            offsets = np.cumsum([0] + sizes[:-1]).tolist()
+
+            if os.path.exists(corpus_file):
+                os.remove(corpus_file)
+            write_corpus_header(corpus_file, {'chars': self.chars, 'dtype': self.dtype.name,
+                                              'size': sum(sizes), 'fingerprints': fingerprints or []})
+
+            # Second pass: encode every file.
+            starmap(functools.partial(encode_file, chars=self.chars, encoding=self.encoding,
+                                      chunk_size=self.chunk_size),
+                    [(input_file, corpus_file, offset)
+                     for input_file, offset in zip(input_files, offsets)])
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # Re-open the corpus as a read-only memory map.
+        self.load_preprocessed(corpus_file)
+
+    def update_preprocessed(self, cached: list, fingerprints: list, input_files: list, corpus_file: str):
+        """Bring a stale corpus file up to date by only encoding text appended since.
+
+        This is possible when every cached file is unchanged except the last one, which
+        may have grown, new files sort after the cached ones & the appended text holds
+        no character missing from the vocab. Existing vocab ids are kept as is.
 
-        # Read input.txt contents.
-        with codecs.open(input_file, mode='r', encoding=self.encoding) as f:
-            data = f.read()
+        Arguments:
+            cached {list} -- (path, fingerprint) of the files the corpus was built from.
+            fingerprints {list} -- (path, fingerprint) of each input file.
+            input_files {list} -- Input files containing the text data.
+            corpus_file {str} -- File where the vocab & numeric representation of dataset is saved.
 
-        # Dictionary of each character & character count.
-        counter = collections.Counter(data)
+        Returns:
+            {bool} -- True if the corpus file was updated, False if it must be rebuilt.
+        """
+        if not cached or [path for path, _ in cached] != [path for path, _ in fingerprints[:len(cached)]]:
+            return False
 
-        # List of tuples: [(' ', 14), ('e', 18), ..., ('m', 1)]
-        count_pairs = sorted(counter.items(), key=lambda x: -x[1])
+        # Every cached file but the last one must be unchanged.
+        if cached[:-1] != fingerprints[:len(cached) - 1]:
+            return False
 
-        # Extract the characters: returns tuple of chars.
-        self.chars, _ = zip(*count_pairs)
+        # Last cached file must start with the content it had when cached.
+        last_file, (_, last_fingerprint) = input_files[len(cached) - 1], cached[-1]
+        if os.path.getsize(last_file) < last_fingerprint['size']:
+            return False
 
-        # Number of characters in the dataset.
-        self.vocab_size = len(self.chars)
+        fingerprint = file_fingerprint(last_file, size=last_fingerprint['size'])
+        if any(fingerprint[key] != last_fingerprint[key] for key in ('head', 'tail')):
+            return False
 
-        # Mapping from char to id or vocab.
-        self.vocab = {c: i for i, c in enumerate(self.chars)}
-        with open(vocab_file, mode='wb') as f:
-            pickle.dump(self.vocab, f)
+        # Appended text: rest of the last cached file & all new files.
+        appended = [(last_file, last_fingerprint['size'])]
+        appended += [(input_file, 0) for input_file in input_files[len(cached):]]
 
-        # Numeric representation of dataset.
-        self.tensor = np.array(list(map(self.vocab.get, data)))
-        np.save(tensor_file, self.tensor)
+        self.load_preprocessed(corpus_file)
 
-    def load_preprocessed(self, vocab_file: str, tensor_file: str):
-        """Load pre-processed data and set all necessary values.
+        # Appended text must fit in the existing vocab.
+        for input_file, offset in appended:
+            counter = count_chars(input_file, encoding=self.encoding,
+                                  chunk_size=self.chunk_size, offset=offset)
+            if any(c not in self.vocab for c in counter):
+                return False
+
+        # Encode & append the new text only.
+        self.tensor = None
+        append_corpus(corpus_file, (self.encode(chunk)
+                                    for input_file, offset in appended
+                                    for chunk in read_chunks(input_file, encoding=self.encoding,
+                                                             chunk_size=self.chunk_size,
+                                                             offset=offset)),
+                      fingerprints=fingerprints)
+
+        self.load_preprocessed(corpus_file)
+        return True
+
+    def tokenize(self, corpus_file: str, num_merges: int):
+        """Byte-pair encode the character corpus into a token file & load it instead.
+
+        Merges are learned from the start of the corpus, then the character ids are
+        encoded a chunk at a time & appended to `tokens-bpe<num_merges>.bin`. The token
+        file is reused until the character corpus it was built from changes.
+
+        Arguments:
+            corpus_file {str} -- Character corpus file, currently loaded.
+            num_merges {int} -- Number of merges to learn.
+        """
+        token_file = os.path.join(self.data_dir, 'tokens-bpe{}.bin'.format(num_merges))
+
+        # The character corpus the tokens were built from.
+        header = read_corpus_header(corpus_file)[0]
+        source = {'size': header['size'], 'fingerprints': header['fingerprints']}
+
+        # Token files without a token order predate ids sorted by frequency.
+        cached = read_corpus_header(token_file)[0] if os.path.exists(token_file) else {}
+        if cached.get('source') != source or 'order' not in cached:
+            print('Learning {:,} byte-pair merges...'.format(num_merges))
+            tokenizer = BytePairEncoder.learn(self.tensor, self.chars, num_merges)
+
+            if os.path.exists(token_file):
+                os.remove(token_file)
+            write_corpus_header(token_file, {'chars': self.chars, 'merges': tokenizer.merges, 'size': 0,
+                                             'dtype': token_dtype(tokenizer.vocab_size).name})
+
+            # Chunks are encoded independently: no merge spans two chunks. Merge ids are
+            # counted along the way.
+            chunk_size = self.chunk_size or 1 << 22
+            counts = np.zeros(tokenizer.vocab_size, dtype=np.int64)
+
+            def merged_chunks():
+                for i in range(0, self.tensor.size, chunk_size):
+                    ids = tokenizer.merge_ids(self.tensor[i:i + chunk_size])
+                    counts[:] += np.bincount(ids, minlength=tokenizer.vocab_size)
+                    yield ids
+
+            size = append_corpus(token_file, merged_chunks())
+
+            # Renumber tokens by decreasing count, in place. The order & source are only
+            # recorded once every token has been renumbered.
+            tokenizer = tokenizer.sort(counts)
+            token_header, body_offset = read_corpus_header(token_file)
+            body = np.memmap(token_file, dtype=token_header['dtype'], mode='r+', offset=body_offset, shape=(size,))
+            for i in range(0, size, chunk_size):
+                body[i:i + chunk_size] = tokenizer.rank[body[i:i + chunk_size]]
+            body.flush()
+            del body
+
+            append_corpus(token_file, (), order=tokenizer.order, source=source)
+
+        self.load_preprocessed(token_file)
+        print('{:,} characters encoded into {:,} tokens.'.format(header['size'], self.tensor.size))
+
+    def encode(self, data: str):
+        """Convert text into its numeric representation using the current vocab.
 
         Arguments:
-            vocab_file {str} -- Files where all unique characters/vocab in the dataset is stored.
-            tensor_file {str} -- File where the numeric representation of dataset is saved.
+            data {str} -- Text to be encoded.
+
+        Returns:
+            {np.ndarray} -- Vocab id of each character (or token) in `data`, stored as `self.dtype`.
+        """
+        if self.tokenizer is not None:
+            return self.tokenizer.encode(data)
+        return encode_chars(data, self.chars, dtype=self.dtype)
+
+    @property
+    def dtype(self):
+        """Smallest unsigned integer type which can hold every vocab id.
+
+        Returns:
+            {np.dtype} -- One of uint8, uint16 or uint32.
         """
-        # Open vocab file & read in all unique chars/vocab.
-        with open(vocab_file, mode='rb') as f:
-            self.chars = pickle.load(f)
+        return token_dtype(self.vocab_size)
 
-        # Create vocab dictionary. & size of all unique characters.
+    def load_preprocessed(self, corpus_file: str):
+        """Load pre-processed data and set all necessary values.
+
+        The corpus file is opened with a single read-only memory map, shared by
+        every training process through the page cache. Only the header is parsed,
+        so opening takes the same time whatever the corpus size.
+
+        Arguments:
+            corpus_file {str} -- File where the vocab & numeric representation of dataset is saved.
+        """
+        with open(corpus_file, mode='rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Header: magic bytes, offset of the token body & JSON metadata.
+        magic, body_offset = CORPUS_PREFIX.unpack_from(buffer)
+        if magic != CORPUS_MAGIC:
+            raise ValueError("{} is not a corpus file.".format(corpus_file))
+        header = json.loads(buffer[CORPUS_PREFIX.size:body_offset].decode('utf-8'))
+
+        # All unique chars/vocab, vocab dictionary & size of all unique characters.
+        # Byte-pair encoded corpora: characters followed by the text of every merge.
+        self.tokenizer = None
+        self.chars = tuple(header['chars'])
+        if header.get('merges'):
+            self.tokenizer = BytePairEncoder(self.chars, header['merges'], order=header.get('order'))
+            self.chars = self.tokenizer.tokens
         self.vocab_size = len(self.chars)
         self.vocab = {c: i for i, c in enumerate(self.chars)}
 
-        # Numeric representation of dataset.
-        self.tensor = np.load(tensor_file)
+        # Numeric representation of dataset: a view of the mapped token body.
+        self.tensor = np.frombuffer(buffer, dtype=header['dtype'],
+                                    count=header['size'], offset=body_offset)
 
     def create_batches(self):
         """Create training  batch.
 
+        The token buffer is split into `batch_size * num_blocks` blocks of equal length.
+        Row `r` of a batch reads blocks `r * num_blocks` to `(r + 1) * num_blocks - 1`
+        in order, unless they're shuffled. Batches are windows into the buffer, with
+        targets being the same windows shifted by one, so nothing is copied up front.
+
         Raises:
             AssertionError -- Not enough data. Make batch_size & seq_len smaller.
         """
         self.num_batches = int(self.tensor.size / (self.batch_size * self.seq_length))
 
+        # Every block must hold the same number of batches.
+        self.num_batches -= self.num_batches % self.num_blocks
+
         # When self.tensor (data) is too small.
         if self.num_batches == 0:
             raise AssertionError("Not enough data. Make batch_size & seq_length small.")
 
-        self.tensor = self.tensor[:self.num_batches * self.batch_size * self.seq_length]
+        # Blocks read by each row, in order.
+        self.blocks = np.arange(self.batch_size * self.num_blocks).reshape(self.batch_size, -1)
 
-        x_data = self.tensor
-        y_data = np.copy(self.tensor)
+    @property
+    def batches_per_block(self):
+        """Number of batches read from the same blocks.
 
-        y_data[:-1] = x_data[1:]
-        y_data[-1] = x_data[0]
+        Returns:
+            {int} -- Number of batches in a block.
+        """
+        return self.num_batches // self.num_blocks
+
+    @property
+    def block_start(self):
+        """Whether the next batch starts new blocks which don't continue the previous ones.
+
+        Recurrent state carried over from the previous batch should be reset when True.
+
+        Returns:
+            {bool} -- True at the start of the epoch or of a shuffled block.
+        """
+        return self.is_block_start(self.pointer)
+
+    def is_block_start(self, pointer: int):
+        """Whether a batch starts new blocks which don't continue the previous ones.
+
+        Arguments:
+            pointer {int} -- Batch index within the epoch.
+
+        Returns:
+            {bool} -- True at the start of the epoch or of a shuffled block.
+        """
+        return pointer == 0 or (self.shuffle and pointer % self.batches_per_block == 0)
+
+    def batch_starts(self, pointer: int):
+        """Position in the token buffer of each row of a batch.
+
+        Arguments:
+            pointer {int} -- Batch index within the epoch.
+
+        Returns:
+            {np.ndarray} -- Start of each row, shape [batch_size].
+        """
+        block, step = divmod(pointer, self.batches_per_block)
+        block_length = self.batches_per_block * self.seq_length
+        return self.blocks[:, block] * block_length + step * self.seq_length
+
+    def window(self, starts: np.ndarray, shift: int = 0):
+        """Windows of `seq_length` tokens into the token buffer.
+
+        Evenly spaced windows are returned as a strided view of the buffer. Others
+        (shuffled blocks, or the last target which wraps around to the first input)
+        are gathered into a new [batch_size, seq_length] array.
+
+        Arguments:
+            starts {np.ndarray} -- Start of each window.
+
+        Keyword Arguments:
+            shift {int} -- Offset added to every start. (default: {0})
+
+        Returns:
+            {np.ndarray} -- Windows, shape [len(starts), seq_length].
+        """
+        starts = starts + shift
+        stride = starts[1] - starts[0] if len(starts) > 1 else 0
 
-        self.x_batch = np.split(np.reshape(x_data, (self.batch_size, -1)),
-                                self.num_batches, axis=1)
-        self.y_batch = np.split(np.reshape(y_data, (self.batch_size, -1)),
-                                self.num_batches, axis=1)
+        if (np.diff(starts) == stride).all() and stride >= 0 and starts[-1] + self.seq_length <= self.tensor.size:
+            itemsize = self.tensor.itemsize
+            return np.lib.stride_tricks.as_strided(self.tensor[starts[0]:],
+                                                   shape=(len(starts), self.seq_length),
+                                                   strides=(stride * itemsize, itemsize),
+                                                   writeable=False)
+
+        return np.take(self.tensor, starts[:, None] + np.arange(self.seq_length), mode='wrap')
 
     def next_batch(self):
         """Generate next training batch.
 
         Returns:
-            {list} -- Next batch with shape [batch_size, -1]
+            {tuple} -- Next inputs & targets, each with shape [batch_size, seq_length]
         """
-        x, y = self.x_batch[self.pointer], self.y_batch[self.pointer]
+        starts = self.batch_starts(self.pointer)
         self.pointer += 1
-        return x, y
+        return self.window(starts), self.window(starts, shift=1)
+
+    def reset_batch_pointer(self, seed: int = None, pointer: int = 0):
+        """Resets batch pointer to 0 & reshuffles blocks if `self.shuffle`.
+
+        Keyword Arguments:
+            seed {int} -- Seed of the block permutation. (default: {None} -- pick one at random)
+            pointer {int} -- Batch to start the epoch from, e.g. to resume an interrupted epoch
+                with its seed. (default: {0})
+        """
+        self.pointer = pointer
+
+        if self.shuffle:
+            self.seed = np.random.randint(2 ** 31) if seed is None else seed
+            permutation = np.random.RandomState(self.seed).permutation(self.blocks.size)
+            self.blocks = permutation.reshape(self.blocks.shape)
+
 
-    def reset_batch_pointer(self):
-        """Resets batch pointer to 0."""
+class BatchPrefetcher:
+    """Prefetch `TextLoader` batches on a background thread.
+
+    A worker thread fills a bounded queue with the batches of the current epoch
+    while the training loop consumes them, so batch preparation overlaps with
+    compute. Time spent by `next_batch` waiting on an empty queue is accumulated
+    in `wait_time`. Every other attribute is read from the wrapped loader.
+
+    Arguments:
+        data_loader {TextLoader} -- Data loader to prefetch batches from.
+
+    Keyword Arguments:
+        depth {int} -- Maximum number of batches prefetched ahead. (default: {2})
+    """
+
+    def __init__(self, data_loader: TextLoader, depth: int = 2):
+        self.data_loader = data_loader
+        self.depth = depth
+
+        # Batch pointer of the consumer, behind the loader's own pointer.
         self.pointer = 0
+
+        # Total & per-epoch time spent waiting for a batch.
+        self.wait_time = 0.0
+        self.epoch_wait_time = 0.0
+
+        self._queue = None
+        self._stop = None
+        self._thread = None
+
+        self.reset_batch_pointer()
+
+    def __getattr__(self, name):
+        if name == 'data_loader':
+            raise AttributeError(name)
+        return getattr(self.data_loader, name)
+
+    @property
+    def block_start(self):
+        """Whether the next batch starts new blocks which don't continue the previous ones.
+
+        Returns:
+            {bool} -- True at the start of the epoch or of a shuffled block.
+        """
+        return self.data_loader.is_block_start(self.pointer)
+
+    def _prefetch(self, batch_queue: queue.Queue, stop: threading.Event):
+        """Worker loop: put the remaining batches of the epoch into `batch_queue`.
+
+        Arguments:
+            batch_queue {queue.Queue} -- Queue of prefetched batches.
+            stop {threading.Event} -- Set to end the worker early.
+        """
+        try:
+            while self.data_loader.pointer < self.data_loader.num_batches and not stop.is_set():
+                x, y = self.data_loader.next_batch()
+                self._put(batch_queue, stop, (np.ascontiguousarray(x), np.ascontiguousarray(y)))
+        except Exception as e:
+            # Re-raised in the consumer's thread.
+            self._put(batch_queue, stop, e)
+
+    @staticmethod
+    def _put(batch_queue: queue.Queue, stop: threading.Event, item):
+        """Wait for room in the queue to put an item, unless asked to stop."""
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+    def next_batch(self):
+        """Get the next prefetched training batch.
+
+        Returns:
+            {tuple} -- Next inputs & targets, each with shape [batch_size, seq_length]
+        """
+        start = time.time()
+        item = self._queue.get()
+        elapsed = time.time() - start
+
+        self.wait_time += elapsed
+        self.epoch_wait_time += elapsed
+
+        if isinstance(item, Exception):
+            raise item
+
+        self.pointer += 1
+        return item
+
+    def reset_batch_pointer(self, seed: int = None, pointer: int = 0):
+        """Stop prefetching the current epoch, reset the loader & start prefetching from `pointer`.
+
+        Keyword Arguments:
+            seed {int} -- Seed of the block permutation. (default: {None} -- pick one at random)
+            pointer {int} -- Batch to start the epoch from. (default: {0})
+        """
+        self.close()
+
+        self.data_loader.reset_batch_pointer(seed=seed, pointer=pointer)
+        self.pointer = pointer
+        self.epoch_wait_time = 0.0
+
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._prefetch, args=(self._queue, self._stop),
+                                        name='BatchPrefetcher', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop the worker thread, discarding any prefetched batch."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None